@@ -1,4 +1,4 @@
-from pymongo import MongoClient
+from pymongo import MongoClient, UpdateOne
 from datetime import datetime, timedelta
 import uuid
 import bcrypt
@@ -124,4 +124,29 @@ class MongoDBManager:
             return bills
         except Exception as e:
             print(f"获取所有账单失败: {e}")
-            return []
\ No newline at end of file
+            return []
+    def iter_bill_chunks(self, fields: list, chunk_size: int = 100000):
+        """分块遍历账单，只读取指定字段(含 _id)"""
+        projection = {field: 1 for field in fields}
+        cursor = self.bills_collection.find({}, projection, batch_size=chunk_size)
+        chunk = []
+        for bill in cursor:
+            chunk.append(bill)
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+    def bulk_update_bills(self, updates: list) -> int:
+        """批量更新账单字段，updates 为 [(_id, {字段: 值})]"""
+        if not updates:
+            return 0
+        try:
+            result = self.bills_collection.bulk_write(
+                [UpdateOne({"_id": bill_id}, {"$set": fields}) for bill_id, fields in updates],
+                ordered=False,
+            )
+            return result.modified_count
+        except Exception as e:
+            print(f"批量更新账单失败: {e}")
+            return 0
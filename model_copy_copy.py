@@ -2,11 +2,19 @@ from enum import Enum
 from datetime import datetime, time as dtime, timedelta
 from MongodbManager import MongoDBManager
 import time
-from typing import Dict, List, Optional, Tuple, Union
+from typing import Callable, Dict, List, NamedTuple, Optional, Tuple, Union
 import uuid
 import threading
 import json
 import heapq
+from contextlib import ExitStack, contextmanager
+import bisect
+import itertools
+import math
+from collections import OrderedDict
+from queue import Empty, Queue
+import numpy as np
+from scipy.optimize import linear_sum_assignment
 
 class Config:
     # 充电桩数量配置
@@ -15,6 +23,9 @@ class Config:
 
     # 等候区和充电队列配置
     WAITING_AREA_SIZE = 6  # 等候区最大车位容量
+    FAULT_HANDLING_DELAY = 3  # 充电桩故障处理耗时(秒)，处理完成前不能恢复服务
+    MAX_WAIT = 1800  # 等候区最长等待(秒)，超过后普通车辆不再被故障车辆插队
+    FAULT_PRIORITY_BONUS = MAX_WAIT  # 故障车辆回到等候区时的优先量(秒)，不小于 MAX_WAIT 时故障车辆排在所有未超过最长等待的普通车辆之前
     CHARGING_QUEUE_LEN = 2  # 充电桩排队队列长度
 
     # 充电功率配置(度/小时) 为了演示加快速度
@@ -27,6 +38,24 @@ class Config:
     FLAT_PRICE = 0.7  # 平时电价(元/度)
     VALLEY_PRICE = 0.4  # 谷时电价(元/度)
 
+    BILL_PRINT_INTERVAL = 10  # 实时详单打印间隔(秒)
+
+    # 调度策略名称，见 SCHEDULING_POLICIES
+    SCHEDULING_POLICY = "priority_on_fault"
+
+    # 影子调度：候选策略名称(None 表示不启用)及对比报告间隔(秒)
+    SHADOW_POLICY = None
+    SHADOW_REPORT_INTERVAL = 60
+
+    # 全局批量调度求解器的时间预算(秒)，及精确求解代价矩阵的最大元素数(车辆数 x 空位数)，超过时只做局部搜索
+    BATCH_SOLVER_TIME_BUDGET = 0.5
+    BATCH_SOLVER_MAX_CELLS = 4_000_000
+
+    # 派车模式: "immediate" 每辆车到达即派车; "batch" 攒批后联合分配
+    DISPATCH_MODE = "immediate"
+    BATCH_WINDOW = 2.0  # 攒批时间窗(秒)，自窗口内第一辆车到达起计
+    BATCH_SIZE = 4  # 窗口内新到达车辆数达到该值时立即派车
+
     ADMIN_ACCOUNTS={
         "admina": "passworda",
         "adminb": "passwordb",
@@ -46,6 +75,17 @@ class PILE_STATUS(Enum):
 
 
 class TIME_PERIOD:
+    # 每日电价时段划分(距当日零点的秒数)，区间为 [起点, 终点)
+    PERIOD_SEGMENTS = [
+        (0, 7 * 3600, "VALLEY"),
+        (7 * 3600, 10 * 3600, "FLAT"),
+        (10 * 3600, 15 * 3600, "PEAK"),
+        (15 * 3600, 18 * 3600, "FLAT"),
+        (18 * 3600, 21 * 3600, "PEAK"),
+        (21 * 3600, 23 * 3600, "FLAT"),
+        (23 * 3600, 24 * 3600, "VALLEY"),
+    ]
+
     def __init__(self, timestamp):
         # 支持传入datetime对象或时间戳
         if isinstance(timestamp, datetime):
@@ -59,9 +99,10 @@ class TIME_PERIOD:
             dtime(18, 0) <= self.current_time.time() < dtime(21, 0)
         )
     def is_valley_time(self):
+        # 与 PERIOD_SEGMENTS 一致，谷时为 [23:00, 7:00)，7:00 整属于平时
         return(
             dtime(23, 0) <= self.current_time.time() or
-            self.current_time.time() <= dtime(7, 0)
+            self.current_time.time() < dtime(7, 0)
         )
     def is_flat_time(self):
         return(
@@ -81,6 +122,16 @@ class TIME_PERIOD:
             return "UNKNOWN"
         
     def calculate_time_period(self, start_time: datetime, end_time: datetime):
+        """统计 [start_time, end_time) 内峰、谷、平各时段时长"""
+        peak_seconds, flat_seconds, valley_seconds = TARIFF_CALENDAR.split(start_time, end_time)
+        return (
+            timedelta(seconds=peak_seconds),
+            timedelta(seconds=valley_seconds),
+            timedelta(seconds=flat_seconds),
+        )
+
+    def _calculate_time_period_by_minute(self, start_time: datetime, end_time: datetime):
+        """旧的逐分钟统计实现，仅保留用于基准对比"""
         peak_duration = timedelta(0)
         valley_duration = timedelta(0)
         flat_duration = timedelta(0)
@@ -88,7 +139,6 @@ class TIME_PERIOD:
         current_time = start_time
 
         while current_time < end_time:
-            # 修改这里：直接传入datetime对象
             period = TIME_PERIOD(current_time).get_period()
             next_minute = current_time + timedelta(minutes=1)
 
@@ -106,25 +156,1012 @@ class TIME_PERIOD:
         return peak_duration, valley_duration, flat_duration
     
 
+class TariffCalendar:
+    """电价日历：预计算每日零点起峰/平/谷累计秒数，任意区间两次查表相减即可"""
+    PERIODS = ("PEAK", "FLAT", "VALLEY")
+
+    def __init__(self, segments=TIME_PERIOD.PERIOD_SEGMENTS):
+        self.boundaries = []  # 各时段起点
+        self.segment_period = []  # 各时段对应 PERIODS 下标
+        self.prefix = []  # 各时段起点处的 (峰, 平, 谷) 累计秒数
+        cumulative = [0, 0, 0]
+        for seg_start, seg_end, period in segments:
+            index = self.PERIODS.index(period)
+            self.boundaries.append(seg_start)
+            self.segment_period.append(index)
+            self.prefix.append(tuple(cumulative))
+            cumulative[index] += seg_end - seg_start
+        self.daily = tuple(cumulative)  # 一整天的 (峰, 平, 谷) 秒数，用于跨天回绕
+
+        # 批量计算使用的数组形式
+        self._boundaries_array = np.array(self.boundaries, dtype=np.float64)
+        self._segment_period_array = np.array(self.segment_period, dtype=np.int64)
+        self._prefix_array = np.array(self.prefix, dtype=np.float64)
+        self._daily_array = np.array(self.daily, dtype=np.float64)
+
+    def _lookup(self, moment):
+        """返回 (日序号, 当日零点起的 (峰, 平, 谷) 累计秒数)"""
+        if not isinstance(moment, datetime):
+            moment = datetime.fromtimestamp(moment)
+        seconds = moment.hour * 3600 + moment.minute * 60 + moment.second + moment.microsecond / 1e6
+        i = bisect.bisect_right(self.boundaries, seconds) - 1
+        cumulative = list(self.prefix[i])
+        cumulative[self.segment_period[i]] += seconds - self.boundaries[i]
+        return moment.toordinal(), cumulative
+
+    def split(self, start_time, end_time) -> Tuple[float, float, float]:
+        """计算 [start_time, end_time) 内 (峰, 平, 谷) 秒数，支持 datetime 或时间戳"""
+        start_day, start_cumulative = self._lookup(start_time)
+        end_day, end_cumulative = self._lookup(end_time)
+        days = end_day - start_day
+        return tuple(
+            max(days * self.daily[j] + end_cumulative[j] - start_cumulative[j], 0.0)
+            for j in range(3)
+        )
+
+    def _lookup_array(self, moments: np.ndarray):
+        """_lookup 的向量化版本，moments 为 datetime64 数组(本地时间)"""
+        moments = moments.astype("datetime64[us]")
+        days = moments.astype("datetime64[D]")
+        seconds = (moments - days).astype(np.int64) / 1e6
+        i = np.searchsorted(self._boundaries_array, seconds, side="right") - 1
+        cumulative = self._prefix_array[i].T.copy()
+        cumulative[self._segment_period_array[i], np.arange(len(i))] += seconds - self._boundaries_array[i]
+        return days.astype(np.int64), cumulative
+
+    def split_array(self, start_times: np.ndarray, end_times: np.ndarray) -> np.ndarray:
+        """批量计算各区间 (峰, 平, 谷) 秒数，返回形状为 (3, n) 的数组"""
+        start_days, start_cumulative = self._lookup_array(start_times)
+        end_days, end_cumulative = self._lookup_array(end_times)
+        days = (end_days - start_days).astype(np.float64)
+        return np.maximum(days * self._daily_array[:, None] + end_cumulative - start_cumulative, 0.0)
+
+    def prices(self) -> Tuple[float, float, float]:
+        """当前 (峰, 平, 谷) 电价，每次读取 Config 以支持调价"""
+        return Config.PEAK_PRICE, Config.FLAT_PRICE, Config.VALLEY_PRICE
+
+    def line_items(self, start_time, end_time, charging_amount: float) -> dict:
+        """按时段拆分账单明细：各时段电量(度)、时长(秒)、电费(元)"""
+        period_seconds = self.split(start_time, end_time)
+        total_seconds = sum(period_seconds)
+        items = {}
+        for period, seconds, price in zip(self.PERIODS, period_seconds, self.prices()):
+            # 按各时段时长占比分摊电量
+            amount = charging_amount * seconds / total_seconds if total_seconds > 0 else 0.0
+            key = period.lower()
+            items[f"{key}_amount"] = amount
+            items[f"{key}_seconds"] = seconds
+            items[f"{key}_fee"] = amount * price
+        return items
+
+    def charging_fee(self, start_time, end_time, charging_amount: float) -> float:
+        """按各时段时长占比分摊电量并计算电费"""
+        items = self.line_items(start_time, end_time, charging_amount)
+        return sum(items[f"{period.lower()}_fee"] for period in self.PERIODS)
+
+
+# 账单中按时段拆分的明细字段
+PERIOD_ITEM_FIELDS = [
+    f"{period.lower()}_{item}"
+    for period in TariffCalendar.PERIODS
+    for item in ("amount", "seconds", "fee")
+]
+
+TARIFF_CALENDAR = TariffCalendar()
+
+
+class LiveMeter:
+    """实时计量器：按上次计量以来的增量累计当前会话的电量与费用"""
+
+    def __init__(self, pile_id: str, power: float, user_id: str, queue_number: str,
+                 request_data: dict, start_time: float):
+        self.pile_id = pile_id
+        self.power = power
+        self.user_id = user_id
+        self.queue_number = queue_number
+        self.username = request_data.get("username", user_id) # 提交请求时缓存的用户名
+        self.start_time = start_time
+        self.full_time = start_time + request_data["amount"] / power * 3600 # 充满时刻
+        self.last_tick = start_time # 上次计量时刻
+        self.charging_amount = 0.0 # 已充电量
+        self.items = {field: 0.0 for field in PERIOD_ITEM_FIELDS} # 分时段累计明细
+
+    def advance(self, now: float) -> None:
+        """累计 [last_tick, now) 的电量和费用，充满后不再增加"""
+        end = min(now, self.full_time)
+        if end <= self.last_tick:
+            return
+        amount = (end - self.last_tick) / 3600 * self.power
+        increment = TARIFF_CALENDAR.line_items(self.last_tick, end, amount)
+        for field in PERIOD_ITEM_FIELDS:
+            self.items[field] += increment[field]
+        self.charging_amount += amount
+        self.last_tick = end
+
+    def remaining_time(self, now: float) -> float:
+        """剩余充电时间(小时)"""
+        return max(self.full_time - now, 0) / 3600
+
+    def snapshot(self, now: float) -> dict:
+        """生成实时详单快照"""
+        self.advance(now)
+        charging_fee = sum(self.items[f"{period.lower()}_fee"] for period in TariffCalendar.PERIODS)
+        service_fee = self.charging_amount * Config.SERVICE_FEE_RATE
+        return {
+            "user_id": self.user_id,
+            "queue_number": self.queue_number,
+            "generated_time": now,
+            "pile_id": self.pile_id,
+            "charging_amount": self.charging_amount,
+            "charging_duration": (self.last_tick - self.start_time) / 3600,
+            "start_time": datetime.fromtimestamp(self.start_time),
+            "end_time": datetime.fromtimestamp(now),
+            "charging_fee": charging_fee,
+            "service_fee": service_fee,
+            "total_fee": charging_fee + service_fee,
+            **self.items,
+        }
+
+
+class TimerTask:
+    """定时任务句柄"""
+
+    def __init__(self, deadline: float, callback, interval: Optional[float] = None):
+        self.deadline = deadline # 下次执行时刻
+        self.callback = callback
+        self.interval = interval # 周期(秒)，None 表示只执行一次
+        self.cancelled = False
+
+    def cancel(self):
+        """取消任务，堆中的条目在到期时被丢弃"""
+        self.cancelled = True
+
+
+class TimerService:
+    """定时服务：单个线程按截止时间小根堆执行所有定时任务"""
+
+    def __init__(self):
+        self._heap = [] # (截止时刻, 序号, 任务)
+        self._counter = 0
+        self._condition = threading.Condition()
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        """启动定时线程"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """停止定时线程并等待其退出，未到期的任务被丢弃"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._thread and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def schedule(self, delay: float, callback, interval: Optional[float] = None) -> TimerTask:
+        """delay 秒后执行 callback，指定 interval 时按周期重复执行"""
+        return self.schedule_at(time.time() + delay, callback, interval)
+
+    def schedule_at(self, deadline: float, callback, interval: Optional[float] = None) -> TimerTask:
+        """在指定时刻执行 callback"""
+        task = TimerTask(deadline, callback, interval)
+        self._push(task)
+        return task
+
+    def _push(self, task: TimerTask):
+        with self._condition:
+            self._counter += 1
+            heapq.heappush(self._heap, (task.deadline, self._counter, task))
+            # 新任务成为堆顶时唤醒定时线程重新计算等待时间
+            if self._heap[0][2] is task:
+                self._condition.notify()
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if self._stopped:
+                        return
+                    while self._heap and self._heap[0][2].cancelled:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    delay = self._heap[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                _, _, task = heapq.heappop(self._heap)
+
+            # 在定时服务的锁之外执行回调
+            try:
+                task.callback()
+            except Exception as e:
+                print(f"Timer task error: {e}")
+
+            if task.interval and not task.cancelled:
+                task.deadline += task.interval
+                self._push(task)
+
+
+class ReadWriteLock:
+    """读写锁：读者可以并发，写者独占且优先于新来的读者，避免写者饥饿
+
+    写锁可重入，持有写锁的线程可以再获取读锁；持有读锁的线程不能升级为写锁。
+    已持有读锁的线程重入读锁时不等待写者，避免自身死锁。
+    直接用作上下文管理器时获取写锁，与 threading.RLock 的用法一致
+    """
+
+    def __init__(self, on_write_release: Optional[Callable[[], None]] = None):
+        """on_write_release 在最外层写锁释放前、仍独占时调用，用于发布写操作的结果"""
+        self.on_write_release = on_write_release
+        self._condition = threading.Condition(threading.Lock())
+        self._readers = {} # 线程ID -> 读锁重入次数
+        self._writer = None # 持有写锁的线程ID
+        self._write_count = 0
+        self._waiting_writers = 0
+
+    def acquire_read(self):
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer == me or me in self._readers:
+                self._readers[me] = self._readers.get(me, 0) + 1
+                return
+            while self._writer is not None or self._waiting_writers:
+                self._condition.wait()
+            self._readers[me] = 1
+
+    def release_read(self):
+        me = threading.get_ident()
+        with self._condition:
+            count = self._readers[me] - 1
+            if count:
+                self._readers[me] = count
+                return
+            del self._readers[me]
+            if not self._readers:
+                self._condition.notify_all()
+
+    def acquire_write(self):
+        me = threading.get_ident()
+        with self._condition:
+            if self._writer == me:
+                self._write_count += 1
+                return
+            if me in self._readers:
+                raise RuntimeError("持有读锁时不能获取写锁")
+            self._waiting_writers += 1
+            try:
+                while self._writer is not None or self._readers:
+                    self._condition.wait()
+            finally:
+                self._waiting_writers -= 1
+            self._writer = me
+            self._write_count = 1
+
+    def release_write(self):
+        # 写锁计数只由持有者修改，这里无需内部锁
+        if self._write_count == 1 and self.on_write_release:
+            try:
+                self.on_write_release()
+            finally:
+                self._release_write()
+        else:
+            self._release_write()
+
+    def _release_write(self):
+        with self._condition:
+            self._write_count -= 1
+            if not self._write_count:
+                self._writer = None
+                self._condition.notify_all()
+
+    @contextmanager
+    def read(self):
+        """读锁上下文"""
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    def __enter__(self):
+        self.acquire_write()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release_write()
+
+
+class SimulatedClock:
+    """虚拟时钟：模拟运行时代替 time.time，只能由调用方向前推进"""
+
+    def __init__(self, start: Optional[float] = None):
+        self.now = time.time() if start is None else start
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance_to(self, t: float):
+        self.now = max(self.now, t)
+
+
+class IndexedQueue:
+    """按用户ID索引的先进先出队列，元素为 (用户ID, 排队号码, 请求数据)
+
+    队首/队尾的插入和弹出以及按用户ID删除均为 O(1)
+    """
+
+    def __init__(self, entries=()):
+        self._entries = OrderedDict()
+        for entry in entries:
+            self.append(entry)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __bool__(self):
+        return bool(self._entries)
+
+    def __iter__(self):
+        return iter(list(self._entries.values()))
+
+    def __contains__(self, user_id: str):
+        return user_id in self._entries
+
+    def __repr__(self):
+        return f"IndexedQueue({list(self._entries.values())})"
+
+    def append(self, entry: tuple) -> None:
+        """加入队尾"""
+        self._entries[entry[0]] = entry
+        self._entries.move_to_end(entry[0])
+
+    def appendleft(self, entry: tuple) -> None:
+        """加入队首"""
+        self._entries[entry[0]] = entry
+        self._entries.move_to_end(entry[0], last=False)
+
+    def popleft(self) -> tuple:
+        """弹出队首"""
+        return self._entries.popitem(last=False)[1]
+
+    def remove(self, user_id: str) -> Optional[tuple]:
+        """按用户ID删除，不存在时返回 None"""
+        return self._entries.pop(user_id, None)
+
+    def get(self, user_id: str) -> Optional[tuple]:
+        """按用户ID查找"""
+        return self._entries.get(user_id)
+
+    def head(self, count: int) -> List[tuple]:
+        """返回队首的 count 个元素(不弹出)"""
+        result = []
+        for entry in self._entries.values():
+            if len(result) >= count:
+                break
+            result.append(entry)
+        return result
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+
+class FenwickTree:
+    """树状数组：单点增减与前缀求和均为 O(log n)"""
+
+    def __init__(self, size: int, values=None):
+        self.size = size
+        self.tree = [0] * (size + 1)
+        if values:
+            # O(n) 建树
+            for i, value in enumerate(values, 1):
+                self.tree[i] += value
+                parent = i + (i & -i)
+                if parent <= size:
+                    self.tree[parent] += self.tree[i]
+
+    def add(self, index: int, delta: int) -> None:
+        index += 1
+        while index <= self.size:
+            self.tree[index] += delta
+            index += index & -index
+
+    def prefix_sum(self, index: int) -> int:
+        """下标 [0, index) 的元素之和"""
+        total = 0
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+
+class RankedQueue(IndexedQueue):
+    """带排名的等候队列：每个元素占用一个到达位置，树状数组统计各位置是否有车
+
+    前方车辆数 = 位置之前的有车位置数，O(log n) 查询；队首插入从中间向左分配位置，
+    队尾插入向右分配，位置用尽时重新居中编号
+    """
+
+    def __init__(self, entries=(), capacity: int = 1024):
+        self._positions = {} # 用户ID -> 到达位置
+        self.epoch = 0 # 位置编号的代数，重新编号时递增
+        self._rebuild(capacity, [])
+        super().__init__(entries)
+
+    def _rebuild(self, capacity: int, entries: List[tuple]) -> None:
+        """重新分配位置并重建树状数组"""
+        self.epoch += 1
+        self._capacity = capacity
+        self._head = (capacity - len(entries)) // 2 # 下一个队首位置为 _head - 1
+        self._tail = self._head # 下一个队尾位置
+        self._positions = {}
+        occupied = [0] * capacity
+        for entry in entries:
+            self._positions[entry[0]] = self._tail
+            occupied[self._tail] = 1
+            self._tail += 1
+        self._tree = FenwickTree(capacity, occupied)
+
+    def _ensure_room(self) -> None:
+        if self._head == 0 or self._tail >= self._capacity:
+            self._rebuild(max(1024, 4 * len(self)), list(self._entries.values()))
+
+    def append(self, entry: tuple) -> None:
+        self.remove(entry[0])
+        self._ensure_room()
+        super().append(entry)
+        self._positions[entry[0]] = self._tail
+        self._tree.add(self._tail, 1)
+        self._tail += 1
+
+    def appendleft(self, entry: tuple) -> None:
+        self.remove(entry[0])
+        self._ensure_room()
+        super().appendleft(entry)
+        self._head -= 1
+        self._positions[entry[0]] = self._head
+        self._tree.add(self._head, 1)
+
+    def popleft(self) -> tuple:
+        entry = super().popleft()
+        self._tree.add(self._positions.pop(entry[0]), -1)
+        return entry
+
+    def remove(self, user_id: str) -> Optional[tuple]:
+        entry = super().remove(user_id)
+        if entry:
+            self._tree.add(self._positions.pop(user_id), -1)
+        return entry
+
+    def clear(self) -> None:
+        super().clear()
+        self._rebuild(self._capacity, [])
+
+    def rank(self, user_id: str) -> int:
+        """前方车辆数，用户不在队列中时返回 -1"""
+        position = self._positions.get(user_id)
+        if position is None:
+            return -1
+        return self._tree.prefix_sum(position)
+
+    @property
+    def capacity(self) -> int:
+        """可分配的位置数"""
+        return self._capacity
+
+    def position(self, user_id: str) -> Optional[int]:
+        """用户的到达位置，重新编号后会改变"""
+        return self._positions.get(user_id)
+
+    def bounds(self) -> Tuple[int, int]:
+        """已分配位置的范围 [首, 尾)"""
+        return self._head, self._tail
+
+    def occupied_before(self, position: int) -> int:
+        """位置 position 之前的车辆数"""
+        return self._tree.prefix_sum(position)
+
+
+class AgingLane:
+    """等候区的一条车道：车辆按键值单调不减的顺序追加，可按键值统计车辆数
+
+    内部用 RankedQueue 维护到达位置和排名，另以位置为下标存放键值供二分查找；
+    键值随位置单调，删除车辆后空出位置上的旧键值仍保持单调，无需清理
+    """
+
+    def __init__(self, offset: float = 0.0, capacity: int = 1024):
+        self.offset = offset # 入队时刻 = 键值 + offset
+        self._queue = RankedQueue((), capacity)
+        self._key_of = {} # 用户ID -> 键值
+        self._keys = [] # 到达位置 -> 键值，队列重新编号后按 _key_of 重建
+        self._epoch = None
+        self._last_key = float('-inf')
+        self._changed = set() # 上次生成视图之后进出或被修改的用户ID
+        self._view = None # 上次生成的视图
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __bool__(self):
+        return bool(self._queue)
+
+    def __contains__(self, user_id: str):
+        return user_id in self._queue
+
+    def __iter__(self):
+        return iter(self._queue)
+
+    def _sync_keys(self) -> None:
+        """队列重新编号后重建位置键值表"""
+        if self._epoch == self._queue.epoch:
+            return
+        self._epoch = self._queue.epoch
+        self._keys = [0.0] * self._queue.capacity
+        for user_id, key in self._key_of.items():
+            self._keys[self._queue.position(user_id)] = key
+
+    def append(self, entry: tuple, key: float) -> None:
+        self.remove(entry[0])
+        # 时钟回拨时沿用上一个键值，保证位置顺序与键值顺序一致
+        key = max(key, self._last_key)
+        self._last_key = key
+        self._queue.append(entry)
+        self._key_of[entry[0]] = key
+        self._sync_keys()
+        self._keys[self._queue.position(entry[0])] = key
+        self._changed.add(entry[0])
+
+    def popleft(self) -> tuple:
+        entry = self._queue.popleft()
+        del self._key_of[entry[0]]
+        self._changed.add(entry[0])
+        return entry
+
+    def remove(self, user_id: str) -> Optional[tuple]:
+        entry = self._queue.remove(user_id)
+        if entry:
+            del self._key_of[user_id]
+            self._changed.add(user_id)
+        return entry
+
+    def touch(self, user_id: str) -> None:
+        """车辆的请求数据被原地修改，下次生成视图时重新渲染"""
+        if user_id in self._queue:
+            self._changed.add(user_id)
+
+    def get(self, user_id: str) -> Optional[tuple]:
+        return self._queue.get(user_id)
+
+    def head(self, count: int) -> List[tuple]:
+        return self._queue.head(count)
+
+    def clear(self) -> None:
+        self._queue.clear()
+        self._key_of.clear()
+
+    def rank(self, user_id: str) -> int:
+        return self._queue.rank(user_id)
+
+    def items(self):
+        """按键值顺序迭代 (键值, 车辆)"""
+        for entry in self._queue:
+            yield self._key_of[entry[0]], entry
+
+    def key(self, user_id: str) -> float:
+        return self._key_of[user_id]
+
+    def head_key(self) -> Optional[float]:
+        """队首键值，空队列返回 None"""
+        for user_id, _, _ in self._queue.head(1):
+            return self._key_of[user_id]
+        return None
+
+    def count_before(self, key: float, inclusive: bool = False) -> int:
+        """键值小于(inclusive 时小于等于) key 的车辆数，O(log n)"""
+        self._sync_keys()
+        find = bisect.bisect_right if inclusive else bisect.bisect_left
+        head, tail = self._queue.bounds()
+        return self._queue.occupied_before(find(self._keys, key, head, tail))
+
+    def sinces(self):
+        """按键值顺序迭代各车辆的入队时刻"""
+        for entry in self._queue:
+            yield self._key_of[entry[0]] + self.offset
+
+    def view(self, render: Callable[[tuple], tuple]) -> "LaneView":
+        """生成不可变视图，render 把车辆转为视图中的行
+
+        只把上次生成视图之后变化的车辆写入上一视图，O(变化数 × log 容量)；队列重新编号后整体重建
+        """
+        queue = self._queue
+        previous = self._view
+        if previous is None or previous.epoch != queue.epoch:
+            previous = LaneView(self.offset, queue.capacity, queue.epoch)
+            changed = self._key_of
+        else:
+            changed = self._changed
+        leaves = {}
+        positions = {}
+        for user_id in changed:
+            old = previous.positions.get(user_id)
+            if old is not None:
+                leaves[old] = None
+            positions[user_id] = None
+        for user_id in changed:
+            entry = queue.get(user_id)
+            if entry:
+                position = queue.position(user_id)
+                leaves[position] = (1, self._key_of[user_id], render(entry))
+                positions[user_id] = position
+        self._view = previous.updated(leaves, positions)
+        self._changed.clear()
+        return self._view
+
+
+def _tree_set(node, lo: int, hi: int, position: int, leaf):
+    """返回把 position 处的叶子替换为 leaf 后的新树，只复制根到叶子的路径"""
+    if hi - lo == 1:
+        return leaf
+    mid = (lo + hi) // 2
+    left, right = (node[2], node[3]) if node else (None, None)
+    if position < mid:
+        left = _tree_set(left, lo, mid, position, leaf)
+    else:
+        right = _tree_set(right, mid, hi, position, leaf)
+    if left is None and right is None:
+        return None
+    count = (left[0] if left else 0) + (right[0] if right else 0)
+    return (count, right[1] if right else left[1], left, right)
+
+
+def _tree_get(node, lo: int, hi: int, position: int):
+    while node is not None and hi - lo > 1:
+        mid = (lo + hi) // 2
+        node, lo, hi = (node[2], lo, mid) if position < mid else (node[3], mid, hi)
+    return node
+
+
+def _tree_count_before(node, lo: int, hi: int, position: int) -> int:
+    """位置 position 之前的车辆数"""
+    total = 0
+    while node is not None and hi - lo > 1:
+        mid = (lo + hi) // 2
+        if position < mid:
+            node, hi = node[2], mid
+        else:
+            total += node[2][0] if node[2] else 0
+            node, lo = node[3], mid
+    return total
+
+
+def _tree_count_below(node, key: float, inclusive: bool) -> int:
+    """键值小于(inclusive 时小于等于) key 的车辆数，要求键值随位置单调不减"""
+    below = (lambda k: k <= key) if inclusive else (lambda k: k < key)
+    total = 0
+    while node is not None:
+        if len(node) == 3: # 叶子
+            return total + below(node[1])
+        count, last, left, right = node
+        if below(last):
+            return total + count
+        if left is None or below(left[1]):
+            total += left[0] if left else 0
+            node = right
+        else:
+            node = left
+    return total
+
+
+def _tree_leaves(node):
+    stack = [node] if node else []
+    while stack:
+        node = stack.pop()
+        if len(node) == 3:
+            yield node
+            continue
+        if node[3]:
+            stack.append(node[3])
+        if node[2]:
+            stack.append(node[2])
+
+
+class LaneView:
+    """车道的不可变视图：以到达位置为下标的持久化线段树，新旧视图共享未变化的子树
+
+    内部节点为 (车辆数, 最后一辆车的键值, 左子树, 右子树)，叶子为 (1, 键值, 行)，空子树为 None；
+    键值随位置单调不减，因此可以按键值二分统计车辆数。接口与 AgingLane 相同，供 aging_rank 等共用
+    """
+
+    def __init__(self, offset: float, capacity: int, epoch: int, root=None,
+                 positions: Optional["PersistentMap"] = None):
+        self.offset = offset
+        self.capacity = capacity
+        self.epoch = epoch # 对应的车道位置编号代数
+        self.root = root
+        self.positions = positions if positions is not None else PersistentMap() # 用户ID -> 到达位置
+
+    def __len__(self):
+        return self.root[0] if self.root else 0
+
+    def __contains__(self, user_id: str):
+        return user_id in self.positions
+
+    def updated(self, leaves: Dict[int, Optional[tuple]], positions: Dict[str, Optional[int]]) -> "LaneView":
+        """返回写入 leaves(位置 -> 叶子，None 表示清空) 和用户位置变化后的新视图"""
+        root = self.root
+        for position, leaf in leaves.items():
+            root = _tree_set(root, 0, self.capacity, position, leaf)
+        return LaneView(self.offset, self.capacity, self.epoch, root, self.positions.update(positions))
+
+    def key(self, user_id: str) -> float:
+        return _tree_get(self.root, 0, self.capacity, self.positions.get(user_id))[1]
+
+    def rank(self, user_id: str) -> int:
+        position = self.positions.get(user_id)
+        if position is None:
+            return -1
+        return _tree_count_before(self.root, 0, self.capacity, position)
+
+    def count_before(self, key: float, inclusive: bool = False) -> int:
+        return _tree_count_below(self.root, key, inclusive)
+
+    def items(self):
+        """按键值顺序迭代 (键值, 行)"""
+        for _, key, row in _tree_leaves(self.root):
+            yield key, row
+
+    def sinces(self):
+        for key, _ in self.items():
+            yield key + self.offset
+
+
+def aging_rank(normal, fault, user_id: str, cutoff: float) -> int:
+    """两条车道合并后的前方车辆数，用户不在队列中时返回 -1，O(log n)
+
+    normal/fault 为 AgingLane 或 LaneView，cutoff 之前入队的普通车辆不再被故障车辆插队
+    """
+    if user_id in normal:
+        key = normal.key(user_id)
+        ahead = normal.rank(user_id)
+        if key <= cutoff:
+            return ahead
+        return ahead + fault.count_before(key)
+    if user_id in fault:
+        key = fault.key(user_id)
+        return fault.rank(user_id) + normal.count_before(max(key, cutoff), inclusive=True)
+    return -1
+
+
+def aging_order(normal, fault, cutoff: float, count: int) -> list:
+    """按叫号顺序返回两条车道的前 count 辆车"""
+    normal_items = list(normal.items())
+    overdue = [item for item in normal_items if item[0] <= cutoff]
+    rest = normal_items[len(overdue):]
+    # 键值相同时普通车辆在前
+    merged = heapq.merge(rest, fault.items(), key=lambda item: item[0])
+    result = [entry for _, entry in overdue[:count]]
+    for _, entry in merged:
+        if len(result) >= count:
+            break
+        result.append(entry)
+    return result
+
+
+def aging_wait_stats(normal, fault, now: float) -> dict:
+    """两条车道的车辆数、最长等待和 p99 等待(秒)"""
+    count = len(normal) + len(fault)
+    # 两条车道的入队时刻各自有序，合并后只需取最早的 1% 车辆
+    oldest = itertools.islice(heapq.merge(normal.sinces(), fault.sinces()), max(1, math.ceil(count * 0.01)))
+    return summarize_waits(count, list(oldest), now)
+
+
+class AgingQueue:
+    """老化感知的等候区：普通车道按入队时刻排队，故障车道的键值提前 FAULT_PRIORITY_BONUS 秒
+
+    车辆的优先级为 优先量 + 已等待时长，所有车辆以相同速率老化，因此按 入队时刻 - 优先量
+    排序就是任意时刻的优先级顺序，两条车道各自单调，叫号只需比较两个队首，O(log n)。
+    普通车辆等待超过 MAX_WAIT 后不再被故障车辆插队，保证最长等待不因故障重排而无限增长。
+    append 为正常排队，appendleft 为故障车辆优先插入
+    """
+
+    def __init__(self, clock: Callable[[], float] = time.time):
+        self.clock = clock
+        self._normal = AgingLane()
+        self._fault = AgingLane(Config.FAULT_PRIORITY_BONUS)
+        self.version = 0 # 内容版本号，车辆进出或请求数据修改时递增
+        self.on_resize = None # 车辆数变化回调，参数为变化量，由充电站设置
+
+    def __len__(self):
+        return len(self._normal) + len(self._fault)
+
+    def __bool__(self):
+        return bool(self._normal) or bool(self._fault)
+
+    def __contains__(self, user_id: str):
+        return user_id in self._normal or user_id in self._fault
+
+    def __iter__(self):
+        return iter(self.head(len(self)))
+
+    def __repr__(self):
+        return f"AgingQueue({self.head(len(self))})"
+
+    def _cutoff(self) -> float:
+        """入队时刻不晚于该值的普通车辆已超过最长等待"""
+        return self.clock() - Config.MAX_WAIT
+
+    def _next_lane(self) -> Optional[AgingLane]:
+        """下一辆应叫号车辆所在的车道"""
+        normal_key = self._normal.head_key()
+        fault_key = self._fault.head_key()
+        if normal_key is None:
+            return self._fault if fault_key is not None else None
+        if fault_key is None or normal_key <= fault_key or normal_key <= self._cutoff():
+            return self._normal
+        return self._fault
+
+    def _resized(self, delta: int) -> None:
+        self.version += 1
+        if delta and self.on_resize:
+            self.on_resize(delta)
+
+    def _take(self, user_id: str) -> Optional[tuple]:
+        return self._normal.remove(user_id) or self._fault.remove(user_id)
+
+    def append(self, entry: tuple) -> None:
+        """正常排队"""
+        moved = self._take(entry[0])
+        self._normal.append(entry, self.clock())
+        self._resized(0 if moved else 1)
+
+    def appendleft(self, entry: tuple) -> None:
+        """故障车辆优先插入"""
+        moved = self._take(entry[0])
+        self._fault.append(entry, self.clock() - self._fault.offset)
+        self._resized(0 if moved else 1)
+
+    def peek(self) -> Optional[tuple]:
+        """下一辆应叫号的车辆(不弹出)"""
+        lane = self._next_lane()
+        return lane.head(1)[0] if lane else None
+
+    def popleft(self) -> tuple:
+        lane = self._next_lane()
+        if lane is None:
+            raise KeyError("等候区为空")
+        entry = lane.popleft()
+        self._resized(-1)
+        return entry
+
+    def remove(self, user_id: str) -> Optional[tuple]:
+        entry = self._take(user_id)
+        if entry:
+            self._resized(-1)
+        return entry
+
+    def touch(self, user_id: str) -> None:
+        """原地修改了队列中车辆的请求数据"""
+        self._normal.touch(user_id)
+        self._fault.touch(user_id)
+        self.version += 1
+
+    def get(self, user_id: str) -> Optional[tuple]:
+        return self._normal.get(user_id) or self._fault.get(user_id)
+
+    def head(self, count: int) -> List[tuple]:
+        """按叫号顺序返回前 count 辆车(不弹出)"""
+        return aging_order(self._normal, self._fault, self._cutoff(), count)
+
+    def clear(self) -> None:
+        count = len(self)
+        self._normal.clear()
+        self._fault.clear()
+        self._resized(-count)
+
+    def rank(self, user_id: str) -> int:
+        """前方车辆数，用户不在队列中时返回 -1，O(log n)"""
+        return aging_rank(self._normal, self._fault, user_id, self._cutoff())
+
+    def wait_stats(self) -> dict:
+        """当前车辆数、最长等待和 p99 等待(秒)"""
+        return aging_wait_stats(self._normal, self._fault, self.clock())
+
+    def views(self, render: Callable[[tuple], tuple]) -> Tuple["LaneView", "LaneView"]:
+        """普通车道和故障车道的不可变视图，只写入上次生成之后的变化"""
+        return self._normal.view(render), self._fault.view(render)
+
+
+def summarize_waits(count: int, oldest: List[float], now: float) -> dict:
+    """由最早的 1% 入队时刻计算车辆数、最长等待和 p99 等待(秒)"""
+    if not count:
+        return {"count": 0, "max_wait": 0.0, "p99_wait": 0.0}
+    return {"count": count, "max_wait": now - oldest[0], "p99_wait": now - oldest[-1]}
+
+
 class ChargingPile:
     """充电桩类"""
 
-    def __init__(self, pile_id: str, mode: CHARGING_MODE):
+    def __init__(self, pile_id: str, mode: CHARGING_MODE, timer: Optional["TimerService"] = None,
+                 clock: Callable[[], float] = time.time):
         self.pile_id = pile_id # 充电桩ID
+        self.clock = clock # 时钟，模拟运行时使用虚拟时钟
         self.mode = mode # 充电模式
-        self.status = PILE_STATUS.AVAILABLE # 充电桩状态
+        self.load_version = 0 # 负载版本号，状态/队列/会话变化时递增
+        self.on_load_change = None # 负载变化回调，由充电站设置
+        self._status = PILE_STATUS.AVAILABLE # 充电桩状态，只能通过 _transition 修改
         self.power = Config.FAST_CHARGING_POWER if mode == CHARGING_MODE.FAST else Config.TRICKLE_CHARGING_POWER # 充电功率
-        self.queue = [] # 排队队列
+        self.queue = IndexedQueue() # 排队队列
+        self.queued_amount = 0.0 # 排队车辆请求电量之和，随入队/出队增量维护
         self.charging_vehicle = None # 当前充电车辆
+        self.meter = None # 当前充电会话的实时计量器
         self.cache = None
 #    数据统计
         self.total_charging_times = 0 # 总充电次数
         self.total_charging_duration = 0 # 总充电时长
         self.total_charging_amount = 0 # 总充电量
 
-        self.print_thread = None # 打印线程
-        self._stop_print_thread = threading.Event() # 停止打印事件
+        self.timer = timer # 充电站共享的定时服务
+        self.print_task = None # 实时详单打印任务
+        self.completion_task = None # 预计充满时刻的结束任务
+        self.on_session_complete = None # 会话充满时的回调，由充电站设置
+        self.on_session_start = None # 会话开始时的回调，由充电站设置
     
+    # 充电桩状态机：当前状态 -> 允许转换到的状态
+    TRANSITIONS = {
+        PILE_STATUS.AVAILABLE: {PILE_STATUS.CHARGING, PILE_STATUS.FAULT, PILE_STATUS.OFF},
+        PILE_STATUS.CHARGING: {PILE_STATUS.AVAILABLE, PILE_STATUS.FAULT, PILE_STATUS.OFF},
+        PILE_STATUS.FAULT: {PILE_STATUS.AVAILABLE, PILE_STATUS.OFF},
+        # 关闭时不中断正在进行的会话，恢复时直接回到充电状态
+        PILE_STATUS.OFF: {PILE_STATUS.AVAILABLE, PILE_STATUS.CHARGING, PILE_STATUS.FAULT},
+    }
+
+    @property
+    def status(self) -> PILE_STATUS:
+        return self._status
+
+    def _transition(self, status: PILE_STATUS) -> bool:
+        """按状态机转换状态并发布变化，非法转换被忽略"""
+        if status == self._status:
+            return True
+        if status not in self.TRANSITIONS[self._status]:
+            print(f"充电桩 {self.pile_id} 非法状态转换: {self._status.name} -> {status.name}")
+            return False
+        self._status = status
+        self._load_changed()
+        return True
+
+    def accepts_vehicles(self) -> bool:
+        """是否在服务中且还有空位，可以接收新车辆"""
+        return self._status in (PILE_STATUS.AVAILABLE, PILE_STATUS.CHARGING) and not self.is_queue_full()
+
+    def free_slots(self) -> int:
+        """剩余车位数(含充电位)"""
+        return Config.CHARGING_QUEUE_LEN - len(self.queue) - (1 if self.charging_vehicle else 0)
+
+    def _load_changed(self) -> None:
+        """状态、排队队列或充电会话发生变化"""
+        self.load_version += 1
+        if self.on_load_change:
+            self.on_load_change(self)
+
+    def projected_free_time(self) -> float:
+        """预计空闲时刻(时间戳)：当前会话充满时刻加上排队电量所需时间，完全空闲时为0
+
+        充电中的值不随时间变化，可以直接作为堆的排序键
+        """
+        meter = self.meter
+        if self.charging_vehicle and meter:
+            base = meter.full_time
+        elif self.queued_amount:
+            base = self.clock()
+        else:
+            return 0.0
+        return base + self.queued_amount / self.power * 3600
+
     def is_queue_full(self):
         """判断队列是否已满"""
         return len(self.queue) >= Config.CHARGING_QUEUE_LEN - 1 # 减1是因为当前充电位不算在队列中
@@ -140,39 +1177,71 @@ class ChargingPile:
         
         # 若队列为空且当前没有车在充电，直接充电 
         if self.is_queue_empty() and self.status == PILE_STATUS.AVAILABLE:
-            self.charging_vehicle = (user_id, queue_number, request, time.time())
-            self.status = PILE_STATUS.CHARGING
+            self._start_session(user_id, queue_number, request)
         # 否则加入排队队列
         else :
-            self.queue.append((user_id, queue_number, request))
-        
-        if self.charging_vehicle and not self.print_thread:
-            self._stop_print_thread.clear()
-            self.print_thread = threading.Thread(target=self._print_bill_periodically, daemon=True)
-            self.print_thread.start()
+            self._enqueue((user_id, queue_number, request))
 
         return True
+
+    def _enqueue(self, entry: tuple) -> None:
+        """加入排队队列并累加排队电量"""
+        self.queue.append(entry)
+        self.queued_amount += entry[2]["amount"]
+        self._load_changed()
+
+    def _dequeue(self, user_id: Optional[str] = None) -> Optional[tuple]:
+        """移出排队车辆(默认队首)并扣减排队电量"""
+        entry = self.queue.remove(user_id) if user_id else self.queue.popleft()
+        if entry:
+            self.queued_amount -= entry[2]["amount"]
+        if not self.queue:
+            self.queued_amount = 0.0 # 队列清空时消除浮点累计误差
+        self._load_changed()
+        return entry
+
+    def clear_queue(self) -> List[tuple]:
+        """清空排队队列(故障/恢复重新调度)，返回被移出的车辆"""
+        entries = list(self.queue)
+        self.queue.clear()
+        self.queued_amount = 0.0
+        self._load_changed()
+        return entries
     
 
-    def _print_bill_periodically(self):
-        while not self._stop_print_thread.is_set():
-            time.sleep(10)  # 每5分钟
-            if self.charging_vehicle:
-                user_id, queue_number, request_data, start_time = self.charging_vehicle
-                now = time.time()
-                duration = (now - start_time) / 3600  # 小时
-                charging_amount = min(request_data["amount"], duration * self.power)
-                user_name = MongoDBManager().get_user_by_id(user_id)["user"]["username"]
-                bill = self.generate_bill(
-                    user_id,
-                    start_time,
-                    now,
-                    charging_amount,
-                    duration,
-                    queue_number,
+    def _start_session(self, user_id: str, queue_number: str, request_data: dict) -> None:
+        """开始一次充电会话"""
+        start_time = self.clock()
+        self.charging_vehicle = (user_id, queue_number, request_data, start_time)
+        self.meter = LiveMeter(self.pile_id, self.power, user_id, queue_number, request_data, start_time)
+        self._transition(PILE_STATUS.CHARGING)
+        if self.on_session_start:
+            self.on_session_start(self, request_data, start_time)
+        if self.timer:
+            self.print_task = self.timer.schedule(
+                Config.BILL_PRINT_INTERVAL, self._print_bill_snapshot, interval=Config.BILL_PRINT_INTERVAL
+            )
+            # 在预计充满时刻触发自动结束
+            if self.on_session_complete:
+                vehicle = self.charging_vehicle
+                self.completion_task = self.timer.schedule_at(
+                    self.meter.full_time, lambda: self.on_session_complete(self, vehicle)
                 )
-                print(f"\n[详单实时打印] 车辆 {user_name} 当前充电详单：")
-                print(json.dumps(bill, indent=2, default=str))
+
+    def busy_seconds(self, now: float) -> float:
+        """累计实际充电时长(秒)，包括进行中的会话"""
+        busy = self.total_charging_duration * 3600
+        if self.meter:
+            busy += min(now, self.meter.full_time) - self.charging_vehicle[3]
+        return busy
+
+    def _print_bill_snapshot(self):
+        """定时任务：打印当前会话的实时详单"""
+        meter = self.meter
+        if self.charging_vehicle and meter:
+            bill = meter.snapshot(self.clock())
+            print(f"\n[详单实时打印] 车辆 {meter.username} 当前充电详单：")
+            print(json.dumps(bill, indent=2, default=str))
             
 
     def remove_from_queue(self, user_id: str, queue_number: str) -> bool:
@@ -181,10 +1250,10 @@ class ChargingPile:
             self.finish_charging()
             return True
         
-        for i, (uid, qn, _) in enumerate(self.queue):
-            if uid == user_id and qn == queue_number:
-                self.queue.pop(i)
-                return True
+        entry = self.queue.get(user_id)
+        if entry and entry[1] == queue_number:
+            self._dequeue(user_id)
+            return True
             
         return False
 
@@ -197,7 +1266,7 @@ class ChargingPile:
         
         # self.status = PILE_STATUS.AVAILABLE
         user_id, queue_number, request_data, start_time = self.charging_vehicle
-        end_time = time.time()
+        end_time = self.clock()
         
         charging_duration = (end_time - start_time) / 3600  # 转换为小时
         
@@ -222,17 +1291,20 @@ class ChargingPile:
         )
         self.cache = self.charging_vehicle
         self.charging_vehicle = None
-        
+        self.meter = None
+        if self.print_task:
+            self.print_task.cancel()
+            self.print_task = None
+        if self.completion_task:
+            self.completion_task.cancel()
+            self.completion_task = None
+
+        # 充电结束后充电桩恢复空闲，故障或关闭状态保持不变
+        if self.status == PILE_STATUS.CHARGING:
+            self._transition(PILE_STATUS.AVAILABLE)
         if self.queue and self.status == PILE_STATUS.AVAILABLE:
-            self.charging_vehicle = (*self.queue.pop(0), time.time())
-            self.status = PILE_STATUS.CHARGING
-        elif not self.queue:
-            self.status = PILE_STATUS.AVAILABLE
-            # todo request_add_queue()
-            # add_request_to_queue()
-
-        self._stop_print_thread.set()
-        self.print_thread = None
+            self._start_session(*self._dequeue())
+        self._load_changed()
 
         return bill
     
@@ -243,8 +1315,7 @@ class ChargingPile:
         
         # 若队列中还有车，则将下一个车辆移动到充电状态
         # if self.queue :
-        self.charging_vehicle = (*self.queue.pop(0), time.time())
-        self.status = PILE_STATUS.CHARGING
+        self._start_session(*self._dequeue())
         # else:
         #     self.status = PILE_STATUS.AVAILABLE
         return True
@@ -253,34 +1324,17 @@ class ChargingPile:
     def generate_bill(self, user_id: str, start_time: float, end_time: float,
                        charging_amount: float, charging_duration: float, queue_number: str,) -> dict:
         """生成账单"""
+        line_items = TARIFF_CALENDAR.line_items(start_time, end_time, charging_amount)
+        charging_fee = sum(line_items[f"{period.lower()}_fee"] for period in TariffCalendar.PERIODS)
         start_time = datetime.fromtimestamp(start_time)
         end_time = datetime.fromtimestamp(end_time)
-
-        # 获取各时间段持续时间（分钟）
-        time_calculator = TIME_PERIOD(start_time)
-
-        peak_duration, valley_duration, flat_duration = time_calculator.calculate_time_period(start_time, end_time)
-        # 总时长（分钟）
-        total_minutes = peak_duration + valley_duration + flat_duration
-
-        # 按占比划分总电量
-        peak_amount = charging_amount * (peak_duration / total_minutes)
-        valley_amount = charging_amount * (valley_duration / total_minutes)
-        flat_amount = charging_amount * (flat_duration / total_minutes)
-        
-        # 分别计算电价
-        charging_fee = (
-            peak_amount * Config.PEAK_PRICE +
-            valley_amount * Config.VALLEY_PRICE +
-            flat_amount * Config.FLAT_PRICE
-        )
         service_fee = charging_amount * Config.SERVICE_FEE_RATE
         
         bill = {
             "bill_id": str(uuid.uuid4()),
             "user_id": user_id,
             "queue_number": queue_number,
-            "generated_time": time.time(),
+            "generated_time": self.clock(),
             "pile_id":self.pile_id,
             "charging_amount": charging_amount,
             "charging_duration": charging_duration,
@@ -289,25 +1343,29 @@ class ChargingPile:
             "charging_fee": charging_fee,
             "service_fee": service_fee,
             "total_fee": charging_fee + service_fee,
+            **line_items,
         }
 
         return bill
     
     
-    def set_status(self, status: PILE_STATUS) -> None:
+    def set_status(self, status: PILE_STATUS) -> Optional[dict]:
+        """管理员设置充电桩状态，返回被故障中断的会话详单"""
         old_status = self.status
-        self.status = status
-        print(self.status)
         bill = None
 
-        if old_status == PILE_STATUS.FAULT and status == PILE_STATUS.AVAILABLE:
-            if  not self.charging_vehicle and self.queue:
-                self.start_next_charging()
-        
-        if status == PILE_STATUS.FAULT and self.charging_vehicle:
-            time.sleep(3)  # 模拟充电桩故障处理时间
-            self.status = PILE_STATUS.FAULT
-            bill = self.finish_charging()
+        if status == PILE_STATUS.AVAILABLE:
+            # 恢复服务；关闭期间仍在进行的会话使充电桩回到充电状态
+            if old_status in (PILE_STATUS.FAULT, PILE_STATUS.OFF):
+                self._transition(PILE_STATUS.CHARGING if self.charging_vehicle else PILE_STATUS.AVAILABLE)
+                if not self.charging_vehicle and self.queue:
+                    self.start_next_charging()
+        else:
+            self._transition(status)
+            # 故障时立即结束当前会话，故障处理耗时由充电站以延时任务模拟
+            if status == PILE_STATUS.FAULT and self.charging_vehicle:
+                bill = self.finish_charging()
+        print(self.status)
         return bill
 
     def get_charging_time_estimate(self, amount: float) -> float:
@@ -315,12 +1373,22 @@ class ChargingPile:
         return amount / self.power    
     
     def get_waiting_time_estimate(self) -> float:
-        """估算排队时间"""
+        """估算排队时间(小时)：当前会话剩余时间 + 排队电量 / 功率，O(1)"""
+        waiting_time = self.queued_amount / self.power
+
+        meter = self.meter
+        if self.charging_vehicle and meter:
+            waiting_time += meter.remaining_time(self.clock()) # 剩余充电时间（小时）
+
+        return waiting_time
+
+    def _get_waiting_time_estimate_by_scan(self) -> float:
+        """逐车重新计算的排队时间，仅用于校验增量维护结果"""
         waiting_time = 0
 
         if self.charging_vehicle:
             user_id,queue_number,request_data,start_time = self.charging_vehicle
-            elapsed_time = (time.time() - start_time) / 3600 # 已充电时间（小时）
+            elapsed_time = (self.clock() - start_time) / 3600 # 已充电时间（小时）
             total_time = request_data["amount"] / self.power # 总充电时间（小时）
             remainning_time = max(total_time - elapsed_time, 0) # 剩余充电时间（小时）
             waiting_time += remainning_time
@@ -332,33 +1400,20 @@ class ChargingPile:
 
     def get_queue_cars_info(self) -> List[dict]:
         """获取排队车辆信息"""
+        now = self.clock()
+        return [car_info(entry, now) for entry in self.queue_entries()]
+
+    def queue_entries(self) -> Tuple[tuple, ...]:
+        """当前充电车辆和排队车辆：(用户ID, 排队号码, 电池容量, 请求电量, 开始计时时刻, 状态)"""
         result = []
-        
-        # 添加当前充电车辆信息
         if self.charging_vehicle:
             user_id, queue_number, request_data, start_time = self.charging_vehicle
-            result.append({
-                "user_id": user_id,
-                "queue_number": queue_number,
-                "battery_capacity": request_data.get("battery_capacity", 0),
-                "request_amount": request_data["amount"],
-                "queue_time": time.time() - start_time,
-                "status": "charging"
-            })
-
-        # 添加充电桩排队车辆信息
+            result.append((user_id, queue_number, request_data.get("battery_capacity", 0),
+                           request_data["amount"], start_time, "charging"))
         for user_id, queue_number, request_data in self.queue:
-            queue_time = time.time() - request_data.get("queue_start_time", time.time())
-            result.append({
-                "user_id": user_id,
-                "queue_number": queue_number,
-                "battery_capacity": request_data.get("battery_capacity", 0),
-                "request_amount": request_data["amount"],
-                "queue_time": queue_time,
-                "status": "queuing_at_pile"
-            })
-        
-        return result
+            result.append((user_id, queue_number, request_data.get("battery_capacity", 0),
+                           request_data["amount"], request_data.get("queue_start_time"), "queuing_at_pile"))
+        return tuple(result)
     
     def get_status_info(self) -> dict:
         """获取充电桩状态信息"""
@@ -373,17 +1428,514 @@ class ChargingPile:
             "charging_vehicle": self.charging_vehicle[1] if self.charging_vehicle else None,
         }
 
+def car_info(entry: tuple, now: float) -> dict:
+    """把车辆条目 (用户ID, 排队号码, 电池容量, 请求电量, 开始计时时刻, 状态) 转为接口返回格式"""
+    user_id, queue_number, battery_capacity, amount, since, status = entry
+    return {
+        "user_id": user_id,
+        "queue_number": queue_number,
+        "battery_capacity": battery_capacity,
+        "request_amount": amount,
+        "queue_time": now - since if since is not None else 0.0,
+        "status": status,
+    }
+
+
+class PersistentMap:
+    """按哈希分层的持久化映射：32 叉、固定 4 层，叶子为小字典
+
+    更新时只复制根到叶子的路径，其余节点在新旧版本之间共享，发布后不再修改
+    """
+
+    BITS = 5
+    LEVELS = 4
+
+    def __init__(self, root: Optional[tuple] = None, size: int = 0):
+        self._root = root
+        self._size = size
+
+    def __len__(self):
+        return self._size
+
+    def _leaf(self, key) -> Optional[dict]:
+        node = self._root
+        index = hash(key)
+        for _ in range(self.LEVELS):
+            if node is None:
+                return None
+            node = node[index & 31]
+            index >>= self.BITS
+        return node
+
+    def __contains__(self, key):
+        leaf = self._leaf(key)
+        return leaf is not None and key in leaf
+
+    def get(self, key, default=None):
+        leaf = self._leaf(key)
+        return leaf.get(key, default) if leaf else default
+
+    def update(self, changes: dict) -> "PersistentMap":
+        """返回应用 changes 后的新映射，值为 None 表示删除该键"""
+        root, size = self._root, self._size
+        for key, value in changes.items():
+            root, delta = self._assoc(root, hash(key), 0, key, value)
+            size += delta
+        return PersistentMap(root, size)
+
+    def _assoc(self, node, index: int, level: int, key, value) -> Tuple[object, int]:
+        """返回 (复制路径后的新节点, 键数变化)"""
+        if level == self.LEVELS:
+            leaf = dict(node) if node else {}
+            existed = key in leaf
+            if value is None:
+                leaf.pop(key, None)
+                return leaf or None, -existed
+            leaf[key] = value
+            return leaf, int(not existed)
+        children = list(node) if node else [None] * 32
+        slot = index & 31
+        children[slot], delta = self._assoc(children[slot], index >> self.BITS, level + 1, key, value)
+        return (tuple(children) if any(children) else None), delta
+
+
+class PileView(NamedTuple):
+    """充电桩的不可变视图"""
+    status_info: dict # get_status_info 的结果，发布后只读
+    accepts_vehicles: bool # 是否有空位且在服务中
+    cars: Tuple[tuple, ...] # queue_entries 的结果，充电车辆在前
+
+
+class WaitingView(NamedTuple):
+    """等候区的不可变视图，行为 (用户ID, 排队号码, 电池容量, 请求电量, 入队时刻, 状态)
+
+    叫号顺序随时间变化(普通车辆超过 MAX_WAIT 后不再被插队)，排名和顺序在读取时按 now 计算
+    """
+    version: int # 对应的 AgingQueue 版本号
+    normal: LaneView
+    fault: LaneView
+
+    def size(self) -> int:
+        return len(self.normal) + len(self.fault)
+
+    def rank(self, user_id: str, now: float) -> int:
+        """前方车辆数，O(log n)"""
+        return aging_rank(self.normal, self.fault, user_id, now - Config.MAX_WAIT)
+
+    def order(self, now: float) -> list:
+        """按叫号顺序排列的行"""
+        return aging_order(self.normal, self.fault, now - Config.MAX_WAIT, self.size())
+
+    def wait_stats(self, now: float) -> dict:
+        return aging_wait_stats(self.normal, self.fault, now)
+
+
+class StationSnapshot(NamedTuple):
+    """充电站某一版本的不可变快照，未变化的充电桩视图、车道子树和用户位置映射节点与上一版本共享"""
+    version: int
+    piles: Dict[str, PileView] # 充电桩ID -> 视图，按充电桩序号排列
+    waiting: Dict[CHARGING_MODE, WaitingView]
+    locations: PersistentMap # 用户ID -> (排队号码, 充电模式, 充电桩ID)
+
+
+def greedy_assignment(vehicles: List[tuple], pile_slots: List[tuple]) -> Dict[str, List[tuple]]:
+    """贪心分配：车辆按充电量从大到小，依次放到当前负载最小且有空位的充电桩
+
+    pile_slots 为 [(充电桩ID, 已有负载(小时), 功率, 空位数)]
+    """
+    assignment = {pile_id: [] for pile_id, _, _, _ in pile_slots}
+    pile_loads = {pile_id: load for pile_id, load, _, _ in pile_slots}
+    pile_powers = {pile_id: power for pile_id, _, power, _ in pile_slots}
+    pile_spaces = {pile_id: space for pile_id, _, _, space in pile_slots}
+
+    for vehicle in sorted(vehicles, key=lambda x: x[2]["amount"], reverse=True):
+        best_pile = None
+        min_load = float('inf')
+        for pile_id in pile_loads:
+            if pile_spaces[pile_id] > 0 and pile_loads[pile_id] < min_load:
+                min_load = pile_loads[pile_id]
+                best_pile = pile_id
+        if best_pile is None:
+            break
+        assignment[best_pile].append(vehicle)
+        pile_loads[best_pile] += vehicle[2]["amount"] / pile_powers[best_pile]
+        pile_spaces[best_pile] -= 1
+    return assignment
+
+
+def _position_costs(vehicles: List[tuple], pile_slots: List[tuple]):
+    """构造指派问题的代价矩阵
+
+    把每个空位看作充电桩上"倒数第 k 个"位置：车辆 i 放在充电桩 p 的倒数第 k 位时，
+    它自己和排在它后面的 k-1 辆车都要等它充完，对总完成时间的贡献为
+    负载_p + k * 充电量_i / 功率_p。代价随 k 递增，最优解总是从倒数第 1 位连续占用
+    """
+    amounts = np.array([vehicle[2]["amount"] for vehicle in vehicles], dtype=np.float64)
+    columns = []
+    positions = [] # 每列对应的 (充电桩ID, k)
+    for pile_id, load, power, space in pile_slots:
+        for k in range(1, space + 1):
+            columns.append(load + k * amounts / power)
+            positions.append((pile_id, k))
+    return np.column_stack(columns), positions
+
+
+def min_completion_assignment(vehicles: List[tuple], pile_slots: List[tuple]) -> Dict[str, List[tuple]]:
+    """最小化总完成时间的分配，化为矩形指派问题用 linear_sum_assignment 精确求解
+
+    车辆数多于空位时只分配其中一部分，返回 {充电桩ID: 按排队顺序排列的车辆}
+    """
+    assignment = {pile_id: [] for pile_id, _, _, _ in pile_slots}
+    if not vehicles or not any(space > 0 for _, _, _, space in pile_slots):
+        return assignment
+    costs, positions = _position_costs(vehicles, pile_slots)
+    rows, cols = linear_sum_assignment(costs)
+
+    placed = {pile_id: [] for pile_id in assignment}
+    for row, col in zip(rows, cols):
+        pile_id, k = positions[col]
+        placed[pile_id].append((k, row))
+    for pile_id, items in placed.items():
+        # 倒数位次大的排在前面
+        assignment[pile_id] = [vehicles[row] for k, row in sorted(items, reverse=True)]
+    return assignment
+
+
+def earliest_finish_assignment(vehicles: List[tuple], pile_slots: List[tuple]) -> Dict[str, List[tuple]]:
+    """贪心分配：车辆按充电量从大到小，依次放到完成时间最早的充电桩，各桩内再按短作业优先排队
+
+    功率相同的充电桩中完成时间最早的就是负载最小的，按功率分组各用一个 (负载, 序号) 小顶堆，
+    每辆车只比较各组堆顶，O(n log P)；完成时间相同时取序号最小的充电桩
+    """
+    assignment = {pile_id: [] for pile_id, _, _, _ in pile_slots}
+    spaces = [space for _, _, _, space in pile_slots]
+    heaps = {} # 功率 -> [(负载, 充电桩序号)]，只包含仍有空位的充电桩
+    for index, (pile_id, load, power, space) in enumerate(pile_slots):
+        if space > 0:
+            heaps.setdefault(power, []).append((load, index))
+    for heap in heaps.values():
+        heapq.heapify(heap)
+
+    for vehicle in sorted(vehicles, key=lambda x: x[2]["amount"], reverse=True):
+        best = None # (完成时间, 充电桩序号, 功率)
+        for power, heap in heaps.items():
+            if heap:
+                load, index = heap[0]
+                candidate = (load + vehicle[2]["amount"] / power, index, power)
+                if best is None or candidate[:2] < best[:2]:
+                    best = candidate
+        if best is None:
+            break
+        completion_time, index, power = best
+        heapq.heappop(heaps[power])
+        assignment[pile_slots[index][0]].append(vehicle)
+        spaces[index] -= 1
+        if spaces[index] > 0:
+            heapq.heappush(heaps[power], (completion_time, index))
+
+    for queue in assignment.values():
+        queue.sort(key=lambda x: x[2]["amount"])
+    return assignment
+
+
+def _pile_completion_time(load: float, power: float, queue: List[tuple]) -> float:
+    """单个充电桩按短作业优先排队时，队列中车辆完成时间之和"""
+    total = 0.0
+    finish = load
+    for vehicle in sorted(queue, key=lambda x: x[2]["amount"]):
+        finish += vehicle[2]["amount"] / power
+        total += finish
+    return total
+
+
+def local_search_assignment(assignment: Dict[str, List[tuple]], pile_slots: List[tuple],
+                            deadline: float, stop: Optional[threading.Event] = None) -> Dict[str, List[tuple]]:
+    """在截止时间前对分配方案做移动/交换局部搜索，返回当前找到的最好方案；stop 被设置时提前结束"""
+    loads = {pile_id: load for pile_id, load, _, _ in pile_slots}
+    powers = {pile_id: power for pile_id, _, power, _ in pile_slots}
+    spaces = {pile_id: space for pile_id, _, _, space in pile_slots}
+    queues = {pile_id: list(assignment.get(pile_id, [])) for pile_id in loads}
+    costs = {pile_id: _pile_completion_time(loads[pile_id], powers[pile_id], queues[pile_id]) for pile_id in loads}
+
+    def evaluate(pile_id, queue):
+        return _pile_completion_time(loads[pile_id], powers[pile_id], queue)
+
+    def expired():
+        return time.perf_counter() >= deadline or (stop is not None and stop.is_set())
+
+    improved = True
+    while improved and not expired():
+        improved = False
+        for a in queues:
+            for i in range(len(queues[a])):
+                if expired():
+                    break
+                vehicle = queues[a][i]
+                rest_a = queues[a][:i] + queues[a][i + 1:]
+                for b in queues:
+                    if b == a:
+                        continue
+                    # 移动：把车辆挪到有空位的充电桩
+                    if len(queues[b]) < spaces[b]:
+                        new_a, new_b = evaluate(a, rest_a), evaluate(b, queues[b] + [vehicle])
+                        if new_a + new_b < costs[a] + costs[b] - 1e-12:
+                            queues[a], queues[b] = rest_a, queues[b] + [vehicle]
+                            costs[a], costs[b] = new_a, new_b
+                            improved = True
+                            break
+                    # 交换：与另一充电桩上的车辆互换
+                    for j, other in enumerate(queues[b]):
+                        swapped_b = queues[b][:j] + [vehicle] + queues[b][j + 1:]
+                        new_a, new_b = evaluate(a, rest_a + [other]), evaluate(b, swapped_b)
+                        if new_a + new_b < costs[a] + costs[b] - 1e-12:
+                            queues[a], queues[b] = rest_a + [other], swapped_b
+                            costs[a], costs[b] = new_a, new_b
+                            improved = True
+                            break
+                    if improved:
+                        break
+                if improved:
+                    break
+            if improved:
+                break
+
+    for queue in queues.values():
+        queue.sort(key=lambda x: x[2]["amount"])
+    return queues
+
+
+# 后台精确求解名额：超出预算被放弃的求解在后台结束前，不再启动新的精确求解
+_exact_solver_slot = threading.Lock()
+
+
+def budgeted_completion_assignment(vehicles: List[tuple], pile_slots: List[tuple],
+                                   time_budget: float) -> Tuple[Dict[str, List[tuple]], str]:
+    """在时间预算内求最小总完成时间的分配，返回 (分配方案, 实际使用的求解方式)
+
+    各充电桩功率不同也不影响位置模型的精确性。精确求解在后台线程进行(linear_sum_assignment 求解期间释放 GIL)，
+    同时以贪心解为起点做局部搜索作为当前最好方案；截止时间前精确解完成则采用精确解，
+    否则返回局部搜索找到的最好方案，精确求解在后台结束后丢弃；代价矩阵超过 BATCH_SOLVER_MAX_CELLS 时只做局部搜索
+    """
+    deadline = time.perf_counter() + time_budget
+    exact = {}
+    done = threading.Event()
+    slots = sum(space for _, _, _, space in pile_slots)
+    started = len(vehicles) * slots <= Config.BATCH_SOLVER_MAX_CELLS and _exact_solver_slot.acquire(blocking=False)
+    if started:
+        def solve():
+            try:
+                exact["assignment"] = min_completion_assignment(vehicles, pile_slots)
+            finally:
+                _exact_solver_slot.release()
+                done.set()
+        threading.Thread(target=solve, daemon=True).start()
+
+    incumbent = local_search_assignment(earliest_finish_assignment(vehicles, pile_slots), pile_slots, deadline, done)
+    if started:
+        done.wait(max(0.0, deadline - time.perf_counter()))
+    if "assignment" in exact:
+        return exact["assignment"], "linear_sum_assignment"
+    return incumbent, "local_search"
+
+
+def total_completion_time(assignment: Dict[str, List[tuple]], pile_slots: List[tuple]) -> float:
+    """分配方案中各车辆完成时间(小时，自当前时刻起)之和"""
+    total = 0.0
+    for pile_id, load, power, _ in pile_slots:
+        finish = load
+        for vehicle in assignment.get(pile_id, []):
+            finish += vehicle[2]["amount"] / power
+            total += finish
+    return total
+
+
+# 调度策略注册表：名称 -> 策略类
+SCHEDULING_POLICIES = {}
+
+
+def register_policy(name: str):
+    """注册调度策略的类装饰器，注册后可通过 Config.SCHEDULING_POLICY 或充电站构造参数按名称选用"""
+    def decorator(cls):
+        cls.name = name
+        SCHEDULING_POLICIES[name] = cls
+        return cls
+    return decorator
+
+
+class SchedulingPolicy:
+    """调度策略：决定等候区叫号派车，以及充电桩故障、恢复时车辆的重新分配
+
+    所有方法都在持有该模式分片写锁时被调用，只能访问该模式的等候区和充电桩
+    """
+    name = None
+
+    def dispatch(self, station: "chargingStation", mode: CHARGING_MODE):
+        """把该模式等候区的车辆派往充电桩"""
+        raise NotImplementedError
+
+    def on_fault(self, station: "chargingStation", fault_pile: ChargingPile, fault_queue: List[tuple]):
+        """故障充电桩上的车辆(被中断的车辆在前)重新分配：默认以故障优先级放回等候区，随后按正常叫号派车"""
+        mode = fault_pile.mode
+        for user_id, queue_number, request_data in fault_queue:
+            station.waiting_area[mode].appendleft((user_id, queue_number, request_data))
+            station._locate(user_id, queue_number, mode)
+
+    def on_recovery(self, station: "chargingStation", recovered_pile: ChargingPile):
+        """充电桩恢复：其他同类型充电桩有车排队时，合并所有尚未充电的车辆按排队号码重新分配"""
+        mode = recovered_pile.mode
+        has_waiting_vehicles = any(
+            p is not recovered_pile and p.mode == mode and p.queue for p in station.piles.values()
+        )
+        if not has_waiting_vehicles:
+            return
+
+        all_waiting_vehicles = []
+        for p in station.piles.values():
+            if p.mode == mode:
+                all_waiting_vehicles.extend(p.clear_queue())
+
+        # 按照排队号码排序（先来先到）
+        all_waiting_vehicles.sort(key=lambda x: int(x[1][1:]))  # 排除首字母，按数字排序
+        for user_id, queue_number, request_data in all_waiting_vehicles:
+            station._schedule_fault_vehicle(user_id, queue_number, request_data, mode)
+
+
+@register_policy("fifo_least_wait")
+class FifoLeastWaitPolicy(SchedulingPolicy):
+    """先来先服务：等候区队首车辆派往预计最早空闲的充电桩"""
+
+    def dispatch(self, station, mode):
+        waiting = station.waiting_area[mode]
+        while waiting:
+            best_pile = station._peek_best_pile(mode)
+            if not best_pile:
+                break
+            user_id, queue_number, request_data = waiting.peek()
+            # 负载变化会把新的堆条目压入
+            if not station._assign_to_pile(best_pile, user_id, queue_number, request_data):
+                break
+            # 按用户ID移除已派出的车辆：两次读取时钟之间可能有普通车辆超过 MAX_WAIT，队首会改变
+            station._pop_waiting(mode, user_id)
+
+
+@register_policy("shortest_job_first")
+class ShortestJobFirstPolicy(FifoLeastWaitPolicy):
+    """短作业优先：等候区中请求电量最小的车辆先派往预计最早空闲的充电桩"""
+
+    def dispatch(self, station, mode):
+        waiting = station.waiting_area[mode]
+        while waiting:
+            best_pile = station._peek_best_pile(mode)
+            if not best_pile:
+                break
+            user_id, queue_number, request_data = min(waiting, key=lambda x: x[2]["amount"])
+            if not station._assign_to_pile(best_pile, user_id, queue_number, request_data):
+                break
+            station._pop_waiting(mode, user_id)
+
+
+@register_policy("priority_on_fault")
+class PriorityOnFaultPolicy(FifoLeastWaitPolicy):
+    """故障优先级调度：故障队列先于等候区，逐辆派往完成时间最短的同类型充电桩"""
+
+    def on_fault(self, station, fault_pile, fault_queue):
+        for user_id, queue_number, request_data in fault_queue:
+            station._schedule_fault_vehicle(user_id, queue_number, request_data, fault_pile.mode, fault_pile)
+
+
+@register_policy("time_ordered_on_fault")
+class TimeOrderedOnFaultPolicy(FifoLeastWaitPolicy):
+    """故障时间顺序调度：故障队列与其他同类型充电桩尚未充电的车辆合并，按排队号码重新分配"""
+
+    def on_fault(self, station, fault_pile, fault_queue):
+        all_waiting_vehicles = list(fault_queue)
+        for p in station.piles.values():
+            if p is not fault_pile and p.mode == fault_pile.mode:
+                all_waiting_vehicles.extend(p.clear_queue())
+
+        # 按照排队号码排序（先来先到）
+        all_waiting_vehicles.sort(key=lambda x: int(x[1][1:]))  # 排除首字母，按数字排序
+        for user_id, queue_number, request_data in all_waiting_vehicles:
+            station._schedule_fault_vehicle(user_id, queue_number, request_data, fault_pile.mode, fault_pile)
+
+
+class StationShard:
+    """充电站按充电模式划分的分片：写锁、调度通知、调度线程、叫号暂停和攒批状态
+
+    该模式的等候区和充电桩仍存放在充电站按模式/充电桩ID索引的字典中，只在持有本分片写锁时修改；
+    两种模式的车辆在正常派车路径上互不相关，因此快充和慢充的提交、叫号、结束充电可以并行
+    """
+
+    def __init__(self, station: "chargingStation", mode: CHARGING_MODE):
+        self.mode = mode
+        # 最外层写锁释放前发布本分片变化的部分
+        self.lock = ReadWriteLock(lambda: station._publish_snapshot((self,)))
+        # 调度通知：本模式的需求或容量变化时唤醒调度线程，使用独立的锁
+        self.schedule_condition = threading.Condition(threading.Lock())
+        self.schedule_pending = False
+        self.call_number_paused = False # 故障/恢复重新分配期间暂停叫号
+        self.batch_arrivals = 0 # 当前攒批窗口内新到达的车辆数
+        self.batch_opened = None # 当前攒批窗口开始时刻
+        # 自上次发布快照以来发生变化的充电桩ID和用户ID
+        self.dirty_piles = set()
+        self.dirty_users = set()
+        self.thread = None # 调度线程
+
+
 class chargingStation:
     """充电站类"""
 
-    def __init__(self):
+    DISPATCH_MODES = ("immediate", "batch") # 派车模式
+
+    def __init__(self, policy: Optional[str] = None, simulated: bool = False,
+                 db_manager: Optional[MongoDBManager] = None):
+        """policy 为调度策略名称，默认取 Config.SCHEDULING_POLICY
+
+        simulated 为 True 时不连接数据库、不启动后台线程，使用虚拟时钟由调用方通过 advance_to 推进，
+        调度在每次请求时同步执行，用于策略基准测试；db_manager 可替换默认的 MongoDB 数据库管理器
+        """
+        self.policy = SCHEDULING_POLICIES[policy or Config.SCHEDULING_POLICY]()
+        self.simulated = simulated
+        self.clock = SimulatedClock() if simulated else time.time
+        self.simulated_bills = [] # 模拟运行时生成的详单
+        self._fault_tasks = {} # 充电桩ID -> 故障处理延时任务
+        self._stopped = False # shutdown 之后调度线程退出
+        self._deferred_recovery = set() # 故障处理完成后需要恢复服务的充电桩ID
+
+        # 全站共享的定时服务，所有充电桩的周期任务都由同一个线程执行
+        self.timer = None
+        if not simulated:
+            self.timer = TimerService()
+            self.timer.start()
+
+        # 各模式可用充电桩的小根堆：(预计空闲时刻, 充电桩序号, 负载版本号, 充电桩ID)，惰性删除过期条目
+        self.pile_heaps = {mode: [] for mode in CHARGING_MODE}
+        self.pile_order = {} # 充电桩ID -> 序号，预计空闲时刻相同时按序号选择
+        # 各模式有空位且在服务中的充电桩ID，由充电桩状态机发布的变化维护
+        self.available_pile_index = {mode: set() for mode in CHARGING_MODE}
+
+        # 按充电模式划分的分片，跨分片操作通过 locked() 按固定顺序获取多个分片的写锁
+        # 加锁顺序：快充分片 -> 慢充分片 -> 准入锁/统计锁/快照锁 -> 调度通知 -> 定时服务/影子事件队列的内部锁，
+        # 不能反向获取；定时回调在定时服务的锁之外执行，数据库读写和密码校验都在分片锁之外进行
+        self.shards = {mode: StationShard(self, mode) for mode in CHARGING_MODE}
+        self.snapshot = None # 最新发布的不可变快照，查询接口无锁读取
+        self._snapshot_lock = threading.Lock() # 两个分片可能同时发布，合并新快照时互斥
+
         self.piles = {} 
         self._init_charging_piles()
 
         self.waiting_area = {
-            CHARGING_MODE.FAST: [], # 快充等候区
-            CHARGING_MODE.TRICKLE: [], # 慢充等候区
+            CHARGING_MODE.FAST: AgingQueue(self.clock), # 快充等候区
+            CHARGING_MODE.TRICKLE: AgingQueue(self.clock), # 慢充等候区
         }
+        # 等候区容量由两种模式共享：准入锁保护等候车辆总数，提交请求时的检查和入队在准入锁内完成
+        self._admission_lock = threading.RLock()
+        self._waiting_total = 0
+        for queue in self.waiting_area.values():
+            queue.on_resize = self._on_waiting_resize
+
+        # 用户位置索引：用户ID -> (排队号码, 充电模式, 充电桩ID)，充电桩ID为None表示在等候区
+        self.user_locations = {}
 
         # 排队号码计数器
         self.queue_counter = {
@@ -396,86 +1948,152 @@ class chargingStation:
         
         # # 用户信息
         # self.users = {} # 用户ID -> 用户信息
-        self.db_manager = MongoDBManager()  # 数据库管理器
+        self.db_manager = None if simulated else (db_manager or MongoDBManager())  # 数据库管理器
+
+        # 最近一次批量调度求解器的统计信息
+        self.last_solver_stats = None
+
+        # 派车模式，只在持有全部分片写锁时切换
+        self.dispatch_mode = Config.DISPATCH_MODE
 
-        # 线程锁
-        self.lock = threading.RLock()
+        # 各派车模式的统计：会话数、累计等待时长、累计充电时长、累计充电桩在线时长
+        self.dispatch_metrics = {
+            mode: {"sessions": 0, "total_wait": 0.0, "busy_seconds": 0.0, "pile_seconds": 0.0}
+            for mode in self.DISPATCH_MODES
+        }
+        self._metrics_since = self.clock()
+        self._metrics_busy_baseline = 0.0
+        self._metrics_lock = threading.Lock() # 两个分片可能同时开始充电会话
+
+        # 影子调度器，接收与本充电站相同的事件流
+        self.shadow = None
+
+        self._publish_snapshot(self.shards.values())
 
-        # 标记等候区叫号服务是否暂停
-        self.call_number_paused = False
+        if simulated:
+            return
 
         self.init_admin_accounts()  # 初始化管理员账户
 
-        # 调度线程
-        self.scheduler_thread = threading.Thread(target=self._scheduler_loop, daemon=True)
-        self.scheduler_thread.start()
+        if Config.SHADOW_POLICY:
+            self.attach_shadow(Config.SHADOW_POLICY)
+
+        # 每个分片一个调度线程
+        for shard in self.shards.values():
+            shard.thread = threading.Thread(target=self._scheduler_loop, args=(shard,), daemon=True)
+            shard.thread.start()
+
+    @contextmanager
+    def locked(self, *modes: CHARGING_MODE):
+        """跨分片操作：按固定顺序(快充 -> 慢充)获取指定分片的写锁，不指定时获取全部分片
+
+        释放之前一次性发布这些分片的变化，跨分片的修改在同一个快照版本中可见
+        """
+        shards = [shard for mode, shard in self.shards.items() if not modes or mode in modes]
+        with ExitStack() as stack:
+            for shard in shards:
+                stack.enter_context(shard.lock)
+            yield
+            self._publish_snapshot(shards)
+
+    @contextmanager
+    def _user_shard(self, user_id: str):
+        """获取用户当前所在分片的写锁，返回其位置；用户不在充电站时返回 None
+
+        加锁前读到的分片可能因修改充电模式而过期，加锁后复核，不一致时重试
+        """
+        while True:
+            location = self.user_locations.get(user_id)
+            if not location:
+                yield None
+                return
+            with self.shards[location[1]].lock:
+                current = self.user_locations.get(user_id)
+                if current is None or current[1] == location[1]:
+                    yield current
+                    return
 
     def _init_charging_piles(self):
         """初始化充电桩"""
         # 初始化快充电桩
         for i in range(Config.FAST_CHARGING_PILE_NUM):
             pile_id = chr(ord('A') + i)
-            self.piles[pile_id] = ChargingPile(pile_id, CHARGING_MODE.FAST)
+            self.piles[pile_id] = ChargingPile(pile_id, CHARGING_MODE.FAST, self.timer, self.clock)
 
         # 初始化慢充电桩
         offset = Config.FAST_CHARGING_PILE_NUM
         for i in range(Config.TRICKLE_CHARGING_PILE_NUM):
             pile_id = chr(ord('A') + offset + i)
-            self.piles[pile_id] = ChargingPile(pile_id, CHARGING_MODE.TRICKLE)
+            self.piles[pile_id] = ChargingPile(pile_id, CHARGING_MODE.TRICKLE, self.timer, self.clock)
+
+        for order, pile in enumerate(self.piles.values()):
+            self.pile_order[pile.pile_id] = order
+            pile.on_session_complete = self._on_session_complete
+            pile.on_session_start = self._on_session_start
+            pile.on_load_change = self._on_pile_load_change
+            self._on_pile_load_change(pile)
     def init_admin_accounts(self):
         """初始化管理员账户"""
-        with self.lock:
-            for username, password in Config.ADMIN_ACCOUNTS.items():
-                # # 检查管理员是否已存在
-                # admin_exists = any(
-                #     user_info.get("username") == username 
-                #     for user_info in self.users.values()
-                # )
+        # 只访问数据库，不需要充电站锁
+        for username, password in Config.ADMIN_ACCOUNTS.items():
+            # # 检查管理员是否已存在
+            # admin_exists = any(
+            #     user_info.get("username") == username 
+            #     for user_info in self.users.values()
+            # )
                 
-                # if not admin_exists:
-                admin_info = {
-                    "username": username,
-                    "password": password,
-                    "car_type": "管理员车辆",
-                    "phone": ""
-                }
-                # self.users[admin_id] = admin_info
-                # self.bills[admin_id] = []
-                result= self.db_manager.register_admin(admin_info)
-                if result["success"]:
-                    print(f"管理员账户 {username} 已创建")
+            # if not admin_exists:
+            admin_info = {
+                "username": username,
+                "password": password,
+                "car_type": "管理员车辆",
+                "phone": ""
+            }
+            # self.users[admin_id] = admin_info
+            # self.bills[admin_id] = []
+            result= self.db_manager.register_admin(admin_info)
+            if result["success"]:
+                print(f"管理员账户 {username} 已创建")
     def register_user(self, user_info: dict) -> dict:
         """注册用户"""
-        with self.lock:
-            # self.users[user_id] = user_info
-            # self.bills[user_id] = []
-            return self.db_manager.register_user(user_info)
+        # 密码哈希和数据库写入都不涉及充电站状态，不持有锁，避免阻塞排队查询和调度
+        # self.users[user_id] = user_info
+        # self.bills[user_id] = []
+        return self.db_manager.register_user(user_info)
 
     def login(self, username: str, password: str) -> Optional[dict]:
         """用户登录"""
-        with self.lock:
-            result = self.db_manager.login(username, password)
-            if result["success"]:
-                return {
-                    "user_id": result["user_id"],
-                    "username": result["username"],
-                    "role": result["role"]
-                }
-            return None
+        # bcrypt 校验耗时较长，不持有锁
+        result = self.db_manager.login(username, password)
+        if result["success"]:
+            return {
+                "user_id": result["user_id"],
+                "username": result["username"],
+                "role": result["role"]
+            }
+        return None
 
     def submit_charging_request(self, user_id: str, mode: CHARGING_MODE, amount: float,
                                  battery_capacity: Optional[float] = None) -> Optional[dict]:
         """提交充电请求"""
-        with self.lock:
-            # 检查用户是否存在
-            # if user_id not in self.users:
-            #     return None
+        # 检查用户是否存在，数据库查询在加锁之前完成
+        # if user_id not in self.users:
+        #     return None
+        if self.simulated:
+            username = user_id
+        else:
             user_result= self.db_manager.get_user_by_id(user_id)
             if not user_result["success"]:
                 return None
-            
+            username = user_result["user"]["username"]
+
+        with self.shards[mode].lock, self._admission_lock:
+            # 每个用户同时只能有一个充电请求，新用户只在准入锁内登记，两个分片不会同时接纳同一用户
+            if user_id in self.user_locations:
+                return None
+
             # 检查等候区是否已满
-            if sum(len(queue) for queue in self.waiting_area.values()) >= Config.WAITING_AREA_SIZE:
+            if self._waiting_total >= Config.WAITING_AREA_SIZE:
                 return None
             
             # 生成排队号码
@@ -484,421 +2102,695 @@ class chargingStation:
             
             # 生成请求数据
             request_data = {
+                "username": username, # 缓存用户名，供实时详单使用
                 "mode": mode,
                 "amount": amount,
                 "battery_capacity": battery_capacity,
-                "queue_start_time": time.time()
+                "queue_start_time": self.clock()
             }
             
             # 加入等候区
             self.waiting_area[mode].append((user_id, queue_number, request_data))
-            self._schedule_vehicles()  # 调度车辆
+            self._locate(user_id, queue_number, mode)
+            self._note_arrival(mode)
+            self._publish("submit", user_id, mode, amount, battery_capacity)
+            self._request_schedule(mode)  # 通知调度线程
             return {"queue_number": queue_number}
+
+    def _on_waiting_resize(self, delta: int) -> None:
+        """等候区车辆数变化，调用方持有该等候区所属分片的写锁"""
+        with self._admission_lock:
+            self._waiting_total += delta
         
+    def _locate(self, user_id: str, queue_number: str, mode: CHARGING_MODE, pile_id: Optional[str] = None):
+        """更新用户位置索引，调用方需持有 mode 所属分片的写锁"""
+        self.user_locations[user_id] = (queue_number, mode, pile_id)
+        self.shards[mode].dirty_users.add(user_id)
+
+    def _forget(self, user_id: str):
+        """用户离开充电站时移除位置索引"""
+        location = self.user_locations.pop(user_id, None)
+        if location:
+            self.shards[location[1]].dirty_users.add(user_id)
+
+    def _assign_to_pile(self, pile: ChargingPile, user_id: str, queue_number: str, request_data: dict) -> bool:
+        """将车辆加入充电桩队列并同步位置索引"""
+        if not pile.add_to_queue(user_id, queue_number, request_data):
+            return False
+        self._locate(user_id, queue_number, pile.mode, pile.pile_id)
+        return True
+
+    def _pop_waiting(self, mode: CHARGING_MODE, user_id: str) -> Optional[tuple]:
+        """从等候区移除指定用户，返回 (用户ID, 排队号码, 请求数据)"""
+        return self.waiting_area[mode].remove(user_id)
+
+    def _publish_snapshot(self, shards):
+        """发布新快照：只重建这些分片中变化的充电桩视图，把变化的车辆和用户位置写入持久化结构，调用方持有这些分片的写锁
+
+        其他分片的部分沿用当前快照；没有任何变化时沿用当前快照，版本号不变
+        """
+        with self._snapshot_lock:
+            previous = self.snapshot
+            if previous is None:
+                piles, waiting, locations, version = {}, {}, PersistentMap(), 0
+            else:
+                piles, waiting, locations, version = previous.piles, previous.waiting, previous.locations, previous.version + 1
+            changed = previous is None
+
+            dirty = set().union(*(shard.dirty_piles for shard in shards))
+            if dirty or previous is None:
+                piles = {pile_id: self._pile_view(pile) if pile_id in dirty or pile_id not in piles else piles[pile_id]
+                         for pile_id, pile in self.piles.items()}
+                changed = True
+
+            stale = [shard.mode for shard in shards
+                     if shard.mode not in waiting or waiting[shard.mode].version != self.waiting_area[shard.mode].version]
+            if stale:
+                waiting = dict(waiting)
+                for mode in stale:
+                    waiting[mode] = self._waiting_view(self.waiting_area[mode])
+                changed = True
+
+            users = set().union(*(shard.dirty_users for shard in shards))
+            if users:
+                locations = locations.update({user_id: self.user_locations.get(user_id) for user_id in users})
+                changed = True
+
+            for shard in shards:
+                shard.dirty_piles.clear()
+                shard.dirty_users.clear()
+            if changed:
+                # 引用赋值是原子的，读者要么看到旧快照，要么看到完整的新快照
+                self.snapshot = StationSnapshot(version, piles, waiting, locations)
+
+    def _pile_view(self, pile: ChargingPile) -> PileView:
+        return PileView(pile.get_status_info(), pile.accepts_vehicles(), pile.queue_entries())
+
+    def _waiting_view(self, queue: AgingQueue) -> WaitingView:
+        return WaitingView(queue.version, *queue.views(self._waiting_row))
+
+    @staticmethod
+    def _waiting_row(entry: tuple) -> tuple:
+        user_id, queue_number, request_data = entry
+        return (user_id, queue_number, request_data.get("battery_capacity", 0), request_data["amount"],
+                request_data.get("queue_start_time"), "waiting_in_area")
+
+    def get_snapshot(self) -> StationSnapshot:
+        """最新发布的快照，同一快照内的充电桩、等候区和用户位置相互一致，跨分片操作在同一版本中可见"""
+        return self.snapshot
+
     def get_queue_number(self, user_id: str) -> Optional[str]:
         """获取用户的排队号码"""
-        with self.lock:
-            # 检查用户是否在等候区
-            for mode in self.waiting_area:
-                for u_id, queue_number, _ in self.waiting_area[mode]:
-                    if u_id == user_id:
-                        return queue_number
-
-            # 检查用户是否在充电区
-            for pile_id, pile in self.piles.items():
-                if pile.charging_vehicle and pile.charging_vehicle[0] == user_id:
-                    return pile.charging_vehicle[1]
-            
-                for u_id, queue_number, _ in pile.queue:
-                    if u_id == user_id:
-                        return queue_number
-            
+        location = self.snapshot.locations.get(user_id)
+        return location[0] if location else None
+
+    def get_user_position(self, user_id: str) -> Optional[dict]:
+        """获取用户当前位置：等候区、充电桩排队或正在充电"""
+        snapshot = self.snapshot
+        location = snapshot.locations.get(user_id)
+        if not location:
             return None
+        queue_number, mode, pile_id = location
+        if pile_id is None:
+            return {
+                "position": "waiting_area",
+                "queue_number": queue_number,
+                "waiting_position": snapshot.waiting[mode].rank(user_id, self.clock()) + 1,
+            }
+        cars = snapshot.piles[pile_id].cars
+        index = next(i for i, car in enumerate(cars) if car[0] == user_id)
+        if cars[index][5] == "charging":
+            return {"position": "charging", "queue_number": queue_number, "pile_id": pile_id}
+        return {
+            "position": "queuing",
+            "queue_number": queue_number,
+            "pile_id": pile_id,
+            "queue_position": index + (cars[0][5] != "charging"),
+        }
 
     def get_waiting_count(self, user_id: str) -> int:
         """获取该模式下前车等待数量"""
-        with self.lock:
-            queue_number = self.get_queue_number(user_id)
-            if not queue_number:
-                return -1
-            
-            mode = CHARGING_MODE.FAST if queue_number.startswith("F") else CHARGING_MODE.TRICKLE
-            count = 0
+        snapshot = self.snapshot
+        location = snapshot.locations.get(user_id)
+        if not location:
+            return -1
+        
+        queue_number, mode, pile_id = location
+        # 已进入充电区的车辆前方没有等候车辆
+        if pile_id is not None:
+            return 0
 
-            # 计算前车等待数量
-            for u_id, q_number, _ in self.waiting_area[mode]:
-                if q_number == queue_number:
-                    break
-                count += 1
-            return count
+        # 计算前车等待数量
+        return snapshot.waiting[mode].rank(user_id, self.clock())
         
+    def get_waiting_metrics(self) -> Dict[str, dict]:
+        """各模式等候区的车辆数、当前最长等待和 p99 等待(秒)"""
+        now = self.clock()
+        return {mode.value: view.wait_stats(now) for mode, view in self.snapshot.waiting.items()}
+
     def get_waiting_area_info(self) -> Dict[str, List[dict]]:
         """获取等候区车辆信息"""
-        with self.lock:
-            result = {}
-            for mode in self.waiting_area:
-                result[mode.value] = []
-                for user_id, queue_number, request_data in self.waiting_area[mode]:
-                    queue_time = time.time() - request_data.get("queue_start_time", time.time())
-                    result[mode.value].append({
-                        "user_id": user_id,
-                        "queue_number": queue_number,
-                        "battery_capacity": request_data.get("battery_capacity", 0),
-                        "request_amount": request_data["amount"],
-                        "queue_time": queue_time,
-                        "status": "waiting_in_area"
-                    })
-            return result
+        now = self.clock()
+        return {
+            mode.value: [car_info(row, now) for row in view.order(now)]
+            for mode, view in self.snapshot.waiting.items()
+        }
         
     def modify_charging_mode(self, user_id: str, new_mode: CHARGING_MODE) -> Optional[str]:
-        """修改充电模式"""
-        with self.lock:
-            # 在等候区修改
-            found = False
-            old_queue_number = None
+        """修改充电模式：车辆从一个分片移到另一个分片，同时持有两个分片的写锁"""
+        with self.locked():
+            # 只允许在等候区修改
+            location = self.user_locations.get(user_id)
+            if not location or location[2] is not None:
+                return None  # 用户不在等候区
+
+            # 删除旧请求
+            _, _, request_data = self._pop_waiting(location[1], user_id)
+
+            # 更新请求模式
+            request_data["mode"] = new_mode
             
-            for mode in self.waiting_area:
-                for i, (u_id, queue_number, _) in enumerate(self.waiting_area[mode]):
-                    if u_id == user_id:
-                        # 删除旧请求
-                        old_queue_number = queue_number
-                        request_data = self.waiting_area[mode].pop(i)[2]
-                        found = True
-                        break
-                
-                if found:
-                    break
+            # 生成新排队号码
+            new_queue_number = f"{new_mode.value}{self.queue_counter[new_mode]}"
+            self.queue_counter[new_mode] += 1
             
-            if found:
-                # 更新请求模式
-                request_data["mode"] = new_mode
-                
-                # 生成新排队号码
-                new_queue_number = f"{new_mode.value}{self.queue_counter[new_mode]}"
-                self.queue_counter[new_mode] += 1
-                
-                # 添加到新模式的等候区末尾
-                self.waiting_area[new_mode].append((user_id, new_queue_number, request_data))
-                
-                return new_queue_number
+            # 添加到新模式的等候区末尾
+            self.waiting_area[new_mode].append((user_id, new_queue_number, request_data))
+            self._locate(user_id, new_queue_number, new_mode)
+            self._publish("modify_mode", user_id, new_mode)
+            self._request_schedule(new_mode)
             
-            return None  # 用户不在等候区
+            return new_queue_number
             
     def modify_charging_amount(self, user_id: str, new_amount: float) -> bool:
         """修改充电量"""
-        with self.lock:
-            #在等待区修改
-            for mode in self.waiting_area:
-                for i, (u_id, queue_number, request_data) in enumerate(self.waiting_area[mode]):
-                    if u_id == user_id:
-                        # 更新充电量
-                        request_data["amount"] = new_amount
-                        self.waiting_area[mode][i] = (u_id, queue_number, request_data)
-                        return True
-                    
-            return False
+        with self._user_shard(user_id) as location:
+            #只允许在等待区修改
+            if not location or location[2] is not None:
+                return False
+
+            # 更新充电量
+            _, _, request_data = self.waiting_area[location[1]].get(user_id)
+            request_data["amount"] = new_amount
+            self.waiting_area[location[1]].touch(user_id)
+            self._publish("modify_amount", user_id, new_amount)
+            self._request_schedule(location[1])
+            return True
 
     def cancel_charging(self, user_id: str) -> bool:
         """取消充电"""
-        with self.lock:
-            # 检查用户是否在等候区
-            for mode in self.waiting_area:
-                for i, (u_id, _, _) in enumerate(self.waiting_area[mode]):
-                    if u_id == user_id:
-                        self.waiting_area[mode].pop(i)
-                        return True
-            
-            # 检查用户是否在充电区
-            for pile_id, pile in self.piles.items():
-                if pile.remove_from_queue(user_id, self.get_queue_number(user_id)):
-                    return True
-            
-            return False
+        with self._user_shard(user_id) as location:
+            if not location:
+                return False
+            queue_number, mode, pile_id = location
+
+            # 用户在等候区
+            if pile_id is None:
+                self._pop_waiting(mode, user_id)
+            # 用户在充电区
+            elif not self.piles[pile_id].remove_from_queue(user_id, queue_number):
+                return False
+
+            self._forget(user_id)
+            self._publish("cancel", user_id)
+            self._request_schedule(mode)
+            return True
 
     def end_charging(self, user_id: str) -> Optional[dict]:
         """结束充电"""
-        with self.lock:
-            queue_number = self.get_queue_number(user_id)
-            if not queue_number:
+        with self._user_shard(user_id) as location:
+            if not location or location[2] is None:
                 return None
             
-            # 查找用户在哪个充电桩
-            for pile_id, pile in self.piles.items():
-                if pile.charging_vehicle and pile.charging_vehicle[0] == user_id:
-                    bill = pile.finish_charging()
-
-                    # 记录账单
-                    if bill:
-                        # if user_id not in self.bills:
-                        #     self.bills[user_id] = []
-                        # self.bills[user_id].append(bill)
-                        success=self.db_manager.save_bill(bill)
-                        print("账单保存"+ ("成功" if success else "失败"))
-                        
-                    return bill
-                
-            return None
+            # 只有正在充电的用户可以结束充电
+            pile = self.piles[location[2]]
+            if not pile.charging_vehicle or pile.charging_vehicle[0] != user_id:
+                return None
+            bill = pile.finish_charging()
+            self._forget(user_id)
+            self._publish("end", user_id)
+
+            # 记录账单
+            unsaved = self._save_bill(bill) if bill else []
+            self._request_schedule(pile.mode)
+        self._flush_bills(unsaved)
+        return bill
+
+    def _on_session_complete(self, pile: ChargingPile, vehicle: tuple) -> None:
+        """定时服务回调：车辆充满请求电量时自动结束充电并叫下一辆车"""
+        with self.shards[pile.mode].lock:
+            # 会话已被手动结束或因故障中断
+            if pile.charging_vehicle is not vehicle:
+                return
+            bill = pile.finish_charging()
+            self._forget(vehicle[0])
+            self._publish("complete", pile.pile_id)
+            unsaved = self._save_bill(bill) if bill else []
+            self._request_schedule(pile.mode)
+        self._flush_bills(unsaved)
+
+    def _save_bill(self, bill: dict) -> List[dict]:
+        """登记详单，返回需要由调用方写库的详单；调用方持有分片写锁，释放锁之后再交给 _flush_bills
+
+        模拟运行时详单直接记入 simulated_bills，不需要写库
+        """
+        if self.simulated:
+            self.simulated_bills.append(bill)
+            return []
+        return [bill]
+
+    def _flush_bills(self, bills: List[dict]) -> None:
+        """把调用方自己的详单写入数据库，返回时这些详单已保存；调用方不能持有分片写锁"""
+        for bill in bills:
+            success = self.db_manager.save_bill(bill)
+            print("账单保存"+ ("成功" if success else "失败"))
         
     def get_bills(self, user_id: str) -> List[dict]:
         """获取用户的账单"""
-        with self.lock:
-            # return self.bills.get(user_id, [])
-            return self.db_manager.get_user_bills(user_id)
+        # return self.bills.get(user_id, [])
+        return self.db_manager.get_user_bills(user_id)
         
     def set_pile_status(self, pile_id: str, status: PILE_STATUS) -> Optional[dict]:
         """设置充电桩状态"""
-        with self.lock:
-            if pile_id not in self.piles:
+        if pile_id not in self.piles:
+            return None
+        pile = self.piles[pile_id]
+        with self.shards[pile.mode].lock:
+            # 故障处理尚未完成时，恢复请求推迟到处理完成后执行
+            if status == PILE_STATUS.AVAILABLE and pile_id in self._fault_tasks:
+                self._deferred_recovery.add(pile_id)
                 return None
-            
-            bill = self.piles[pile_id].set_status(status)
-            
+            self._deferred_recovery.discard(pile_id)
+
+            old_status = pile.status
+            self._publish("status", pile_id, status)
+            # 被中断的车辆不移出位置索引，故障处理重新调度时原地更新位置；
+            # 否则在重新登记之前，另一分片会通过每用户一个请求的检查再次接纳该用户
+            bill = pile.set_status(status)
+
             # 如果充电桩状态变为故障，需要处理故障队列
             if status == PILE_STATUS.FAULT:
-                self.piles[pile_id].status = status
-                self._handle_pile_fault(pile_id)
-            # 如果充电桩状态从故障恢复，需要重新调度
-            elif self.piles[pile_id].status == PILE_STATUS.AVAILABLE and status == PILE_STATUS.AVAILABLE:
+                self._handle_pile_fault(pile_id, pile.cache if bill else None)
+                self._schedule_fault_handling(pile_id)
+            # 如果充电桩状态从故障或关闭恢复，需要重新调度
+            elif status == PILE_STATUS.AVAILABLE and old_status in (PILE_STATUS.FAULT, PILE_STATUS.OFF):
                 self._handle_pile_recovery(pile_id)
-                self.piles[pile_id].status = status
-            else :
-                self.piles[pile_id].status = status
             # 保存详单
-            if bill:
-                # user_id = bill["user_id"]
-                # if user_id not in self.bills:
-                #     self.bills[user_id] = []
-                # self.bills[user_id].append(bill)
-                success = self.db_manager.save_bill(bill)
-                print("账单保存"+ ("成功" if success else "失败"))
-            
-            return bill
+            unsaved = self._save_bill(bill) if bill else []
+            self._request_schedule(pile.mode)
+        self._flush_bills(unsaved)
+        return bill
     
+    def _schedule_fault_handling(self, pile_id: str):
+        """把故障处理耗时登记为延时任务，调用方需持有该充电桩所属分片的写锁；模拟运行时没有定时服务，直接视为处理完成"""
+        if not self.timer or Config.FAULT_HANDLING_DELAY <= 0:
+            return
+        task = self._fault_tasks.pop(pile_id, None)
+        if task:
+            task.cancel()
+        self._fault_tasks[pile_id] = self.timer.schedule(
+            Config.FAULT_HANDLING_DELAY, lambda: self._finish_fault_handling(pile_id)
+        )
+
+    def _finish_fault_handling(self, pile_id: str):
+        """定时服务回调：故障处理完成，执行期间收到的恢复请求"""
+        with self.shards[self.piles[pile_id].mode].lock:
+            self._fault_tasks.pop(pile_id, None)
+            recover = pile_id in self._deferred_recovery
+            self._deferred_recovery.discard(pile_id)
+        print(f"充电桩 {pile_id} 故障处理完成")
+        if recover:
+            self.set_pile_status(pile_id, PILE_STATUS.AVAILABLE)
+
     def get_pile_status(self, pile_id: Optional[str] = None) -> Union[dict, List[dict]]:
         """获取充电桩状态"""
-        with self.lock:
-            if pile_id:
-                if pile_id in self.piles:
-                    return self.piles[pile_id].get_status_info()
-                return None
-            
-            # 返回所有充电桩状态
-            return [pile.get_status_info() for pile in self.piles.values()]
+        piles = self.snapshot.piles
+        if pile_id:
+            if pile_id in piles:
+                return dict(piles[pile_id].status_info)
+            return None
+        
+        # 返回所有充电桩状态
+        return [dict(view.status_info) for view in piles.values()]
     
     def get_pile_queue_cars(self, pile_id: Optional[str] = None) -> Union[List[dict], Dict[str, List[dict]]]:
         """获取充电桩排队车辆信息"""
-        with self.lock:
-            if pile_id:
-                if pile_id in self.piles:
-                    return self.piles[pile_id].get_queue_cars_info()
-                return []
-            
-            # 返回所有充电桩排队车辆信息
-            result = {}
-            for p_id, pile in self.piles.items():
-                result[p_id] = pile.get_queue_cars_info()
-            return result
+        piles = self.snapshot.piles
+        now = self.clock()
+        if pile_id:
+            if pile_id in piles:
+                return [car_info(entry, now) for entry in piles[pile_id].cars]
+            return []
+        
+        # 返回所有充电桩排队车辆信息
+        return {p_id: [car_info(entry, now) for entry in view.cars] for p_id, view in piles.items()}
     
     def generate_report(self, start_time: float, end_time: float, period: str = "day") -> List[dict]:
         """生成报表"""
-        with self.lock:
-            # 筛选时间范围内的详单
-            all_bills=self.db_manager.get_all_bills()
-            period_bills = []
-            for bill in all_bills:
-                # 将datetime对象转换为时间戳进行比较
-                bill_start_time = bill["start_time"]
-                if isinstance(bill_start_time, datetime):
-                    bill_start_timestamp = bill_start_time.timestamp()
-                else:
-                    bill_start_timestamp = bill_start_time
+        # 只读取数据库中的详单，不持有锁
+        # 筛选时间范围内的详单
+        all_bills=self.db_manager.get_all_bills()
+        period_bills = []
+        for bill in all_bills:
+            # 将datetime对象转换为时间戳进行比较
+            bill_start_time = bill["start_time"]
+            if isinstance(bill_start_time, datetime):
+                bill_start_timestamp = bill_start_time.timestamp()
+            else:
+                bill_start_timestamp = bill_start_time
                     
-                if start_time <= bill_start_timestamp <= end_time:
-                    period_bills.append(bill)
+            if start_time <= bill_start_timestamp <= end_time:
+                period_bills.append(bill)
             
-            # 按照充电桩分组统计
-            pile_stats = {}
-            for bill in period_bills:
-                pile_id = bill["pile_id"]
-                if pile_id not in pile_stats:
-                    pile_stats[pile_id] = {
-                        "total_times": 0,
-                        "total_duration": 0,
-                        "total_amount": 0,
-                        "total_charging_fee": 0,
-                        "total_service_fee": 0,
-                        "total_fee": 0
-                    }
+        # 按照充电桩分组统计
+        pile_stats = {}
+        for bill in period_bills:
+            pile_id = bill["pile_id"]
+            if pile_id not in pile_stats:
+                pile_stats[pile_id] = {
+                    "total_times": 0,
+                    "total_duration": 0,
+                    "total_amount": 0,
+                    "total_charging_fee": 0,
+                    "total_service_fee": 0,
+                    "total_fee": 0,
+                    **{field: 0 for field in PERIOD_ITEM_FIELDS},
+                }
                 
-                pile_stats[pile_id]["total_times"] += 1
-                pile_stats[pile_id]["total_duration"] += bill["charging_duration"]
-                pile_stats[pile_id]["total_amount"] += bill["charging_amount"]
-                pile_stats[pile_id]["total_charging_fee"] += bill["charging_fee"]
-                pile_stats[pile_id]["total_service_fee"] += bill["service_fee"]
-                pile_stats[pile_id]["total_fee"] += bill["total_fee"]
+            # 旧账单没有分时段明细时按起止时间补算
+            if any(field not in bill for field in PERIOD_ITEM_FIELDS):
+                bill.update(TARIFF_CALENDAR.line_items(bill["start_time"], bill["end_time"], bill["charging_amount"]))
+            for field in PERIOD_ITEM_FIELDS:
+                pile_stats[pile_id][field] += bill[field]
+
+            pile_stats[pile_id]["total_times"] += 1
+            pile_stats[pile_id]["total_duration"] += bill["charging_duration"]
+            pile_stats[pile_id]["total_amount"] += bill["charging_amount"]
+            pile_stats[pile_id]["total_charging_fee"] += bill["charging_fee"]
+            pile_stats[pile_id]["total_service_fee"] += bill["service_fee"]
+            pile_stats[pile_id]["total_fee"] += bill["total_fee"]
             
-            # 生成报表
-            report = [] 
-            for pile_id, stats in pile_stats.items():
-                report.append({
-                    "time_period": period,
-                    "pile_id": pile_id,
-                    "total_charging_times": stats["total_times"],
-                    "total_charging_duration": stats["total_duration"],
-                    "total_charging_amount": stats["total_amount"],
-                    "total_charging_fee": stats["total_charging_fee"],
-                    "total_service_fee": stats["total_service_fee"],
-                    "total_fee": stats["total_fee"]
-                })
+        # 生成报表
+        report = [] 
+        for pile_id, stats in pile_stats.items():
+            report.append({
+                "time_period": period,
+                "pile_id": pile_id,
+                "total_charging_times": stats["total_times"],
+                "total_charging_duration": stats["total_duration"],
+                "total_charging_amount": stats["total_amount"],
+                "total_charging_fee": stats["total_charging_fee"],
+                "total_service_fee": stats["total_service_fee"],
+                "total_fee": stats["total_fee"],
+                **{f"total_{field}": stats[field] for field in PERIOD_ITEM_FIELDS},
+            })
             
-            return report
+        return report
     
-    def _scheduler_loop(self):
-        """调度循环"""
+    def rerate_bills(self, chunk_size: int = 100000) -> dict:
+        """按当前费率重算历史账单，分块读取并批量写回"""
+        fields = ["start_time", "end_time", "charging_amount"]
+        rerated_count = 0
+        t0 = time.time()
+        for chunk in self.db_manager.iter_bill_chunks(fields, chunk_size):
+            fees = rerate_bill_arrays(
+                _to_datetime64([bill["start_time"] for bill in chunk]),
+                _to_datetime64([bill["end_time"] for bill in chunk]),
+                np.array([bill["charging_amount"] for bill in chunk], dtype=np.float64),
+            )
+            columns = {name: values.tolist() for name, values in fees.items()}
+            updates = [
+                (bill["_id"], {name: columns[name][i] for name in columns})
+                for i, bill in enumerate(chunk)
+            ]
+            rerated_count += self.db_manager.bulk_update_bills(updates)
+        return {"rerated_count": rerated_count, "elapsed": time.time() - t0}
+
+    def _request_schedule(self, *modes: CHARGING_MODE):
+        """通知调度线程：这些模式的充电桩容量或等候区需求发生了变化，不指定时通知全部分片
+
+        调用方需持有相应分片的写锁
+        """
+        for mode in modes or CHARGING_MODE:
+            shard = self.shards[mode]
+            if self.simulated:
+                # 模拟运行没有调度线程，直接同步调度
+                if not shard.call_number_paused:
+                    self._dispatch(mode)
+                continue
+            with shard.schedule_condition:
+                shard.schedule_pending = True
+                shard.schedule_condition.notify()
+
+    def _scheduler_loop(self, shard: StationShard):
+        """分片调度循环：没有变化时阻塞等待，收到通知后加本分片写锁调度；攒批模式下先等待攒批窗口结束"""
         while True:
+            with shard.schedule_condition:
+                while not self._stopped and (not shard.schedule_pending or shard.call_number_paused):
+                    shard.schedule_condition.wait()
+                if self._stopped:
+                    return
+                if self.dispatch_mode == "batch":
+                    self._wait_for_batch(shard)
+                    if self._stopped or shard.call_number_paused:
+                        continue
+                shard.schedule_pending = False
             try:
-                with self.lock:
-                    if not self.call_number_paused:
-                        self._schedule_vehicles()
-                
-                # 每秒调度一次
-                time.sleep(1)
+                with shard.lock:
+                    # 等待期间可能开始了故障处理
+                    if not shard.call_number_paused:
+                        self._dispatch(shard.mode)
             except Exception as e:
                 print(f"Scheduling error: {e}")
-                time.sleep(5)  # 出错时等待5秒再继续
+
+    def _dispatch(self, mode: CHARGING_MODE):
+        """按当前派车模式对该模式调度一次"""
+        if self.dispatch_mode == "batch":
+            self._dispatch_batch(mode)
+        else:
+            self._schedule_vehicles(mode)
+
+    def advance_to(self, t: float):
+        """模拟运行：把虚拟时钟推进到 t，按时间顺序结束期间充满的会话"""
+        with self.locked():
+            while True:
+                due = [
+                    (pile.meter.full_time, pile.pile_id) for pile in self.piles.values()
+                    if pile.charging_vehicle and pile.meter and pile.meter.full_time <= t
+                ]
+                if not due:
+                    break
+                full_time, pile_id = min(due)
+                self.clock.advance_to(full_time)
+                pile = self.piles[pile_id]
+                self._on_session_complete(pile, pile.charging_vehicle)
+            self.clock.advance_to(t)
+
+    def _note_arrival(self, mode: CHARGING_MODE):
+        """攒批模式下记录该模式新到达的车辆，调用方需持有该分片的写锁"""
+        if self.dispatch_mode != "batch":
+            return
+        shard = self.shards[mode]
+        with shard.schedule_condition:
+            if not shard.batch_arrivals:
+                shard.batch_opened = time.time()
+            shard.batch_arrivals += 1
+
+    def _wait_for_batch(self, shard: StationShard):
+        """等待攒批窗口结束：超过 BATCH_WINDOW 秒或攒满 BATCH_SIZE 辆车，调用方需持有分片的 schedule_condition
+
+        没有新到达车辆时(如充电桩空出位置)不等待
+        """
+        if not shard.batch_arrivals:
+            return
+        deadline = shard.batch_opened + Config.BATCH_WINDOW
+        while shard.batch_arrivals < Config.BATCH_SIZE and self.dispatch_mode == "batch" and not self._stopped:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            shard.schedule_condition.wait(remaining)
+        shard.batch_arrivals = 0
+        shard.batch_opened = None
+
+    def _dispatch_batch(self, mode: CHARGING_MODE):
+        """对该模式等候区的车辆做一次联合分配"""
+        if self.waiting_area[mode]:
+            self.batch_schedule_vehicles(mode)
+
+    def set_dispatch_mode(self, dispatch_mode: str) -> bool:
+        """切换派车模式，并结算上一模式的统计区间"""
+        if dispatch_mode not in self.DISPATCH_MODES:
+            return False
+        with self.locked():
+            if dispatch_mode != self.dispatch_mode:
+                now = self.clock()
+                self._close_metrics_period(now)
+                self.dispatch_mode = dispatch_mode
+                self._publish("dispatch_mode", dispatch_mode)
+                for shard in self.shards.values():
+                    with shard.schedule_condition:
+                        shard.batch_arrivals = 0
+                        shard.batch_opened = None
+                self._request_schedule()
+            return True
+
+    def _on_session_start(self, pile: ChargingPile, request_data: dict, start_time: float):
+        """充电会话开始：把该车从排队到开始充电的等待时长计入当前派车模式"""
+        with self._metrics_lock:
+            metrics = self.dispatch_metrics[self.dispatch_mode]
+            metrics["sessions"] += 1
+            metrics["total_wait"] += start_time - request_data.get("queue_start_time", start_time)
+
+    def _total_busy_seconds(self, now: float) -> float:
+        return sum(pile.busy_seconds(now) for pile in self.piles.values())
+
+    def _close_metrics_period(self, now: float):
+        """把当前统计区间的充电时长和充电桩在线时长计入当前派车模式，调用方需持有全部分片的写锁"""
+        metrics = self.dispatch_metrics[self.dispatch_mode]
+        busy = self._total_busy_seconds(now)
+        metrics["busy_seconds"] += busy - self._metrics_busy_baseline
+        metrics["pile_seconds"] += (now - self._metrics_since) * len(self.piles)
+        self._metrics_since = now
+        self._metrics_busy_baseline = busy
+
+    def get_dispatch_metrics(self) -> Dict[str, dict]:
+        """各派车模式的平均等待时长(秒)和充电桩利用率"""
+        with self.locked():
+            self._close_metrics_period(self.clock())
+            return {
+                mode: {
+                    "sessions": metrics["sessions"],
+                    "mean_wait": metrics["total_wait"] / metrics["sessions"] if metrics["sessions"] else 0.0,
+                    "utilization": metrics["busy_seconds"] / metrics["pile_seconds"] if metrics["pile_seconds"] else 0.0,
+                    "active": mode == self.dispatch_mode,
+                }
+                for mode, metrics in self.dispatch_metrics.items()
+            }
     
-    def _schedule_vehicles(self):
-        """调度车辆进入充电区"""
-        # 检查每个充电桩模式
-        for mode in [CHARGING_MODE.FAST, CHARGING_MODE.TRICKLE]:
-            if not self.waiting_area[mode]:
-                continue
-                
-            # 找到该模式下可用的充电桩
-            available_piles = []
-            for pile_id, pile in self.piles.items():
-                if (pile.mode == mode and 
-                    pile.status != PILE_STATUS.FAULT and 
-                    not pile.is_queue_full()):
-                    available_piles.append((pile_id, pile))
-            
-            if not available_piles:
-                continue
-                
-            # 调度等候区的车辆
-            while self.waiting_area[mode] and available_piles:
-                # 从等候区取出第一辆车
-                user_id, queue_number, request_data = self.waiting_area[mode].pop(0)
-                
-                # 查找最适合的充电桩（等待时间最短）
-                best_pile_id = None
-                min_waiting_time = float('inf')
-                
-                for pile_id, pile in available_piles:
-                    waiting_time = pile.get_waiting_time_estimate()
-                    if waiting_time < min_waiting_time:
-                        min_waiting_time = waiting_time
-                        best_pile_id = pile_id
-                
-                if best_pile_id:
-                    # 将车辆添加到充电桩队列
-                    success = self.piles[best_pile_id].add_to_queue(user_id, queue_number, request_data)
-                    if success:
-                        # 如果充电桩队列已满，从可用列表中移除
-                        if self.piles[best_pile_id].is_queue_full():
-                            available_piles = [(pid, p) for pid, p in available_piles if pid != best_pile_id]
-                    else:
-                        # 如果添加失败，将车辆放回等候区
-                        self.waiting_area[mode].insert(0, (user_id, queue_number, request_data))
-                        break
+    def _publish(self, kind: str, *args):
+        """把事件转发给影子调度器，只做入队，不在调用方线程中计算"""
+        if self.shadow:
+            self.shadow.publish(self.clock(), kind, args)
+
+    def attach_shadow(self, policy: str) -> bool:
+        """以候选策略启动影子调度，只对挂载之后的事件做对比"""
+        if policy not in SCHEDULING_POLICIES:
+            return False
+        with self.locked():
+            if self.shadow:
+                self.shadow.stop()
+            self.shadow = ShadowScheduler(self.policy.name, policy, self.dispatch_mode)
+            self.shadow.start()
+            return True
+
+    def detach_shadow(self):
+        """停止影子调度"""
+        with self.locked():
+            if self.shadow:
+                self.shadow.stop()
+                self.shadow = None
+
+    def shutdown(self):
+        """停止调度线程、定时服务和影子调度，等待线程退出；模拟运行没有后台线程
+
+        供测试和基准测试在结束时释放充电站，调用方不能持有分片写锁
+        """
+        self._stopped = True
+        for shard in self.shards.values():
+            with shard.schedule_condition:
+                shard.schedule_condition.notify_all()
+            if shard.thread:
+                shard.thread.join()
+        if self.timer:
+            self.timer.stop()
+        self.detach_shadow()
+
+    def get_shadow_report(self) -> Optional[dict]:
+        """最近一次影子调度对比报告"""
+        shadow = self.shadow
+        return shadow.last_report if shadow else None
+
+    def _on_pile_load_change(self, pile: ChargingPile) -> None:
+        """充电桩状态/负载变化：更新可用充电桩索引，并把最新的预计空闲时刻压入所属模式的堆"""
+        self.shards[pile.mode].dirty_piles.add(pile.pile_id)
+        index = self.available_pile_index[pile.mode]
+        if not pile.accepts_vehicles():
+            index.discard(pile.pile_id)
+            return
+        index.add(pile.pile_id)
+        heap = self.pile_heaps[pile.mode]
+        heapq.heappush(heap, (pile.projected_free_time(), self.pile_order[pile.pile_id], pile.load_version, pile.pile_id))
+        # 过期条目过多时重建
+        if len(heap) > 4 * len(self.pile_order) + 16:
+            heap[:] = [
+                (self.piles[pid].projected_free_time(), self.pile_order[pid], self.piles[pid].load_version, pid)
+                for pid in index
+            ]
+            heapq.heapify(heap)
+
+    def _available_piles(self, mode: CHARGING_MODE) -> List[ChargingPile]:
+        """该模式下有空位且在服务中的充电桩，按编号排序"""
+        return sorted(
+            (self.piles[pile_id] for pile_id in self.available_pile_index[mode]),
+            key=lambda pile: self.pile_order[pile.pile_id],
+        )
+
+    def get_available_piles(self, mode: Optional[CHARGING_MODE] = None) -> Dict[str, List[str]]:
+        """获取各模式有空位的充电桩ID"""
+        piles = self.snapshot.piles
+        modes = [mode] if mode else list(CHARGING_MODE)
+        return {
+            m.value: [pile_id for pile_id, view in piles.items()
+                      if view.accepts_vehicles and view.status_info["mode"] == m.value]
+            for m in modes
+        }
+
+    def _peek_best_pile(self, mode: CHARGING_MODE) -> Optional[ChargingPile]:
+        """返回该模式下预计最早空闲的可用充电桩，跳过过期条目"""
+        heap = self.pile_heaps[mode]
+        while heap:
+            _, _, version, pile_id = heap[0]
+            pile = self.piles[pile_id]
+            if version == pile.load_version and pile.pile_id in self.available_pile_index[mode]:
+                return pile
+            heapq.heappop(heap)
+        return None
+
+    def _schedule_vehicles(self, mode: CHARGING_MODE):
+        """调度该模式的车辆进入充电区，由调度策略决定派车方式"""
+        self.policy.dispatch(self, mode)
     
-    def _handle_pile_fault(self, fault_pile_id: str):
-        """处理充电桩故障"""
-        # 暂停等候区叫号服务
-        self.call_number_paused = True
-        
+    def _handle_pile_fault(self, fault_pile_id: str, interrupted_vehicle: Optional[tuple] = None):
+        """处理充电桩故障，interrupted_vehicle 为被故障中断的充电车辆"""
         fault_pile = self.piles[fault_pile_id]
-        mode = fault_pile.mode
-        
-        # 优先级调度：将故障充电桩的等候队列车辆重新调度
-        if fault_pile:
-            fault_queue = []  # 故障队列
-            if fault_pile.cache:
-                fault_queue.append((fault_pile.cache[0], fault_pile.cache[1], fault_pile.cache[2]))
-            if fault_pile.queue:
-                fault_queue.append(fault_pile.queue.copy())
-            fault_pile.queue = []  # 清空故障充电桩队列
-            
-            # 按照策略选择处理方式：1为优先级调度，2为时间顺序调度
-            strategy = 1  # 可配置
-            
-            if strategy == 1:  # 优先级调度
-                # 首先尝试调度故障队列中的车辆
-                for user_id, queue_number, request_data in fault_queue:
-                    self._schedule_fault_vehicle(user_id, queue_number, request_data, mode, fault_pile)
-
-            elif strategy == 2:  # 时间顺序调度
-                # 收集所有同类型充电桩中尚未充电的车辆
-                all_waiting_vehicles = []
-                
-                # 加入故障充电桩的排队车辆
-                for user_id, queue_number, request_data in fault_queue:
-                    all_waiting_vehicles.append((user_id, queue_number, request_data))
-                
-                # 收集其他同类型充电桩中尚未充电的车辆
-                for p_id, p in self.piles.items():
-                    if p_id != fault_pile_id and p.mode == mode:
-                        for user_id, queue_number, request_data in p.queue:
-                            all_waiting_vehicles.append((user_id, queue_number, request_data))
-                        # 清空其他充电桩队列
-                        p.queue = []
-                
-                # 按照排队号码排序（先来先到）
-                all_waiting_vehicles.sort(key=lambda x: int(x[1][1:]))  # 排除首字母，按数字排序
-                
-                # 按顺序重新调度
-                for user_id, queue_number, request_data in all_waiting_vehicles:
-                    self._schedule_fault_vehicle(user_id, queue_number, request_data, mode, fault_pile)
+        shard = self.shards[fault_pile.mode]
+        # 暂停该模式等候区叫号服务
+        shard.call_number_paused = True
+
+        fault_queue = []  # 故障队列
+        if interrupted_vehicle:
+            fault_queue.append(interrupted_vehicle[:3])
+        fault_queue.extend(fault_pile.clear_queue())  # 清空故障充电桩队列
+
+        # 由调度策略重新分配故障队列
+        self.policy.on_fault(self, fault_pile, fault_queue)
         
         # 重新开启等候区叫号服务
-        self.call_number_paused = False
+        shard.call_number_paused = False
+        self._request_schedule(fault_pile.mode)
     
     def _handle_pile_recovery(self, recovered_pile_id: str):
         """处理充电桩恢复"""
-        # 暂停等候区叫号服务
-        self.call_number_paused = True
-        
         recovered_pile = self.piles[recovered_pile_id]
-        mode = recovered_pile.mode
-        
-        # 检查其他同类型充电桩是否有车辆排队
-        has_waiting_vehicles = False
-        for p_id, p in self.piles.items():
-            if p_id != recovered_pile_id and p.mode == mode and p.queue:
-                has_waiting_vehicles = True
-                break
+        shard = self.shards[recovered_pile.mode]
+        # 暂停该模式等候区叫号服务
+        shard.call_number_paused = True
         
-        if has_waiting_vehicles:
-            # 收集所有同类型充电桩中尚未充电的车辆
-            all_waiting_vehicles = []
-            
-            # 收集所有同类型充电桩中尚未充电的车辆
-            for p_id, p in self.piles.items():
-                if p.mode == mode:
-                    for user_id, queue_number, request_data in p.queue:
-                        all_waiting_vehicles.append((user_id, queue_number, request_data))
-                    # 清空充电桩队列
-                    p.queue = []
-            
-            # 按照排队号码排序（先来先到）
-            all_waiting_vehicles.sort(key=lambda x: int(x[1][1:]))  # 排除首字母，按数字排序
-            
-            # 按顺序重新调度
-            for user_id, queue_number, request_data in all_waiting_vehicles:
-                self._schedule_fault_vehicle(user_id, queue_number, request_data, mode)
+        self.policy.on_recovery(self, recovered_pile)
         
         # 重新开启等候区叫号服务
-        self.call_number_paused = False
+        shard.call_number_paused = False
+        self._request_schedule(recovered_pile.mode)
     
     def _schedule_fault_vehicle(self, user_id: str, queue_number: str, request_data: dict, mode: CHARGING_MODE, fault_pile: Optional[ChargingPile] = None):
         """调度故障车辆到其他充电桩"""
@@ -906,119 +2798,95 @@ class chargingStation:
         best_pile = None
         min_completion_time = float('inf')
         
-        for p_id, p in self.piles.items():
+        for p in self._available_piles(mode):
             if p == fault_pile:
                 continue
-            if p.mode == mode and p.status == PILE_STATUS.AVAILABLE and not p.is_queue_full() :
-                # 计算等待时间
-                waiting_time = p.get_waiting_time_estimate()
-                # 计算自己充电时间
-                charging_time = p.get_charging_time_estimate(request_data["amount"])
-                # 总完成时间
-                completion_time = waiting_time + charging_time
-                
-                if completion_time < min_completion_time:
-                    min_completion_time = completion_time
-                    best_pile = p_id
+            # 计算等待时间
+            waiting_time = p.get_waiting_time_estimate()
+            # 计算自己充电时间
+            charging_time = p.get_charging_time_estimate(request_data["amount"])
+            # 总完成时间
+            completion_time = waiting_time + charging_time
+            
+            if completion_time < min_completion_time:
+                min_completion_time = completion_time
+                best_pile = p
         
         if best_pile:
             # 将车辆添加到充电桩队列
-            self.piles[best_pile].add_to_queue(user_id, queue_number, request_data)
+            self._assign_to_pile(best_pile, user_id, queue_number, request_data)
         else:
             # 如果没有合适的充电桩，将车辆放回等候区
-            self.waiting_area[mode].insert(0, (user_id, queue_number, request_data))
+            self.waiting_area[mode].appendleft((user_id, queue_number, request_data))
+            self._locate(user_id, queue_number, mode)
     
     def batch_schedule_vehicles(self, mode: CHARGING_MODE) -> bool:
         """扩展功能：单次调度总充电时长最短"""
-        with self.lock:
+        with self.shards[mode].lock:
             # 检查该模式下有多少个空位
             available_slots = 0
             available_piles = []
-            for pile_id, pile in self.piles.items():
-                if pile.mode == mode and pile.status == PILE_STATUS.AVAILABLE:
-                    # 每个充电桩可用的空位数
-                    available_space = Config.CHARGING_QUEUE_LEN - len(pile.queue) - (1 if pile.charging_vehicle else 0)
-                    if available_space > 0:
-                        available_slots += available_space
-                        available_piles.append((pile_id, available_space))
+            for pile in self._available_piles(mode):
+                # 每个充电桩可用的空位数
+                available_space = pile.free_slots()
+                if available_space > 0:
+                    available_slots += available_space
+                    available_piles.append((pile.pile_id, available_space))
             
             # 如果没有空位，返回
             if available_slots == 0:
                 return False
             
             # 取等候区该模式下的车辆，最多取available_slots个
-            waiting_vehicles = self.waiting_area[mode][:available_slots]
+            waiting_vehicles = self.waiting_area[mode].head(available_slots)
             if not waiting_vehicles:
                 return False
             
-            # 从等候区移除这些车辆
-            self.waiting_area[mode] = self.waiting_area[mode][len(waiting_vehicles):]
-            
             # 计算所有可能的分配方案，找出总充电时长最短的方案
             best_assignment = self._find_optimal_assignment(waiting_vehicles, available_piles)
             
-            # 执行最优分配方案
+            # 执行最优分配方案，分配成功的车辆才离开等候区，其余保持原有排队位置
             if best_assignment:
                 for pile_id, assigned_vehicles in best_assignment.items():
                     for user_id, queue_number, request_data in assigned_vehicles:
-                        self.piles[pile_id].add_to_queue(user_id, queue_number, request_data)
+                        if self._assign_to_pile(self.piles[pile_id], user_id, queue_number, request_data):
+                            self._pop_waiting(mode, user_id)
                 return True
-            
-            # 如果没有找到合适的方案，将车辆放回等候区
-            self.waiting_area[mode] = waiting_vehicles + self.waiting_area[mode]
             return False
     
+    def _pile_slots(self, available_piles) -> List[tuple]:
+        """[(充电桩ID, 空位数)] -> [(充电桩ID, 已有负载(小时), 功率, 空位数)]"""
+        return [
+            (pile_id, self.piles[pile_id].get_waiting_time_estimate(), self.piles[pile_id].power, space)
+            for pile_id, space in available_piles
+        ]
+
     def _find_optimal_assignment(self, vehicles, available_piles):
-        """寻找最优分配方案"""
-        # 这是一个复杂的组合优化问题，使用简化的贪心算法
-        # 实际应用中可能需要使用更复杂的算法如匈牙利算法或线性规划
-        
+        """寻找最优分配方案：以充电桩各空位为位置的指派问题，最小化总完成时间"""
         if not vehicles or not available_piles:
             return {}
-        
-        # 将车辆按照充电量排序（从大到小）
-        vehicles.sort(key=lambda x: x[2]["amount"], reverse=True)
-        
-        # 将充电桩按照当前负载排序（从小到大）
-        available_piles.sort(key=lambda x: self.piles[x[0]].get_waiting_time_estimate())
-        
-        # 贪心分配：将每辆车分配到当前负载最小的合适充电桩
-        assignment = {pile_id: [] for pile_id, _ in available_piles}
-        pile_loads = {pile_id: self.piles[pile_id].get_waiting_time_estimate() for pile_id, _ in available_piles}
-        pile_spaces = {pile_id: space for pile_id, space in available_piles}
-        
-        for vehicle in vehicles:
-            user_id, queue_number, request_data = vehicle
-            mode = request_data["mode"]
-            
-            # 寻找负载最小且还有空间的充电桩
-            best_pile = None
-            min_load = float('inf')
-            
-            for pile_id in pile_loads:
-                if pile_spaces[pile_id] > 0 and self.piles[pile_id].mode == mode:
-                    if pile_loads[pile_id] < min_load:
-                        min_load = pile_loads[pile_id]
-                        best_pile = pile_id
-            
-            if best_pile:
-                # 分配车辆到充电桩
-                assignment[best_pile].append(vehicle)
-                # 更新充电桩负载和空间
-                pile_loads[best_pile] += self.piles[best_pile].get_charging_time_estimate(request_data["amount"])
-                pile_spaces[best_pile] -= 1
-        
+
+        pile_slots = self._pile_slots(available_piles)
+        t0 = time.perf_counter()
+        assignment = min_completion_assignment(vehicles, pile_slots)
+        self.last_solver_stats = {
+            "solver": "linear_sum_assignment",
+            "latency_ms": (time.perf_counter() - t0) * 1000,
+            "vehicles": len(vehicles),
+            "slots": sum(space for _, space in available_piles),
+            "total_completion_time": total_completion_time(assignment, pile_slots),
+        }
         return assignment
-    
+
     def batch_schedule_all_vehicles(self) -> bool:
-        """扩展功能：批量调度总充电时长最短"""
-        with self.lock:
+        """扩展功能：批量调度总充电时长最短，车辆可能被分配到另一模式的充电桩，同时持有两个分片的写锁"""
+        with self.locked():
             # # 计算充电区总车位数
             # total_slots = sum(Config.CHARGING_QUEUE_LEN for _ in self.piles)
             available_piles = [
-                (pile_id, Config.CHARGING_QUEUE_LEN - len(pile.queue) - (1 if pile.charging_vehicle else 0)) 
-                for pile_id, pile in self.piles.items()
-                if pile.status == PILE_STATUS.AVAILABLE
+                (pile.pile_id, pile.free_slots())
+                for mode in CHARGING_MODE
+                for pile in self._available_piles(mode)
             ]
             total_slots = sum(space for _, space in available_piles)
             # 收集所有等候区车辆
@@ -1033,89 +2901,177 @@ class chargingStation:
             # 取前total_slots个车辆
             selected_vehicles = all_vehicles[:total_slots]
             
-            # 从等候区移除这些车辆
-            for mode in self.waiting_area:
-                self.waiting_area[mode] = []
-            
-            remaining_vehicles = all_vehicles[total_slots:]
-            for user_id, queue_number, request_data in remaining_vehicles:
-                self.waiting_area[request_data["mode"]].append((user_id, queue_number, request_data))
-            
             # 计算所有可能的分配方案，找出总充电时长最短的方案
             best_assignment = self._find_optimal_assignment_all(selected_vehicles)
             
-            # 执行最优分配方案
+            # 执行最优分配方案，分配成功的车辆才离开等候区，其余保持原有排队位置
             if best_assignment:
                 for pile_id, assigned_vehicles in best_assignment.items():
                     for user_id, queue_number, request_data in assigned_vehicles:
-                        self.piles[pile_id].add_to_queue(user_id, queue_number, request_data)
+                        mode = self.user_locations[user_id][1]
+                        if self._assign_to_pile(self.piles[pile_id], user_id, queue_number, request_data):
+                            self._pop_waiting(mode, user_id)
                 return True
-            
-            # 如果没有找到合适的方案，将车辆放回等候区
-            for user_id, queue_number, request_data in selected_vehicles:
-                self.waiting_area[request_data["mode"]].append((user_id, queue_number, request_data))
             return False
     
     def _find_optimal_assignment_all(self, vehicles):
-        """寻找最优全局分配方案（忽略充电模式限制）"""
-        # 这是一个更复杂的组合优化问题，使用简化的贪心算法
-        
+        """寻找最优全局分配方案（忽略充电模式限制），在时间预算内求解"""
         if not vehicles:
             return {}
-        
-        # 将车辆按照充电量排序（从大到小）
-        vehicles.sort(key=lambda x: x[2]["amount"], reverse=True)
-        
+
         # 将所有充电桩纳入考虑
-        available_piles = [(pile_id, Config.CHARGING_QUEUE_LEN - len(pile.queue) - (1 if pile.charging_vehicle else 0)) 
-                          for pile_id, pile in self.piles.items() if pile.status == PILE_STATUS.AVAILABLE]
-        
-        # 将充电桩按照当前负载排序（从小到大）
-        available_piles.sort(key=lambda x: self.piles[x[0]].get_waiting_time_estimate())
-        
-        # 贪心分配：将每辆车分配到当前负载最小的充电桩
-        assignment = {pile_id: [] for pile_id, _ in available_piles}
-        pile_loads = {pile_id: self.piles[pile_id].get_waiting_time_estimate() for pile_id, _ in available_piles}
-        pile_spaces = {pile_id: space for pile_id, space in available_piles}
-        
-        for vehicle in vehicles:
-            user_id, queue_number, request_data = vehicle
-            
-            # 计算在不同充电桩上的充电时间
-            charging_times = {}
-            for pile_id, pile in self.piles.items():
-                if pile_id in pile_spaces and pile_spaces[pile_id] > 0:
-                    # 充电时间 = 充电量 / 充电功率
-                    charging_time = request_data["amount"] / pile.power
-                    charging_times[pile_id] = charging_time
-            
-            # 寻找总完成时间最短的充电桩
-            best_pile = None
-            min_completion_time = float('inf')
-            
-            for pile_id, charging_time in charging_times.items():
-                if pile_spaces[pile_id] > 0:
-                    completion_time = pile_loads[pile_id] + charging_time
-                    if completion_time < min_completion_time:
-                        min_completion_time = completion_time
-                        best_pile = pile_id
-            
-            if best_pile:
-                # 分配车辆到充电桩
-                assignment[best_pile].append(vehicle)
-                # 更新充电桩负载和空间
-                pile_loads[best_pile] += charging_times[best_pile]
-                pile_spaces[best_pile] -= 1
-        
+        available_piles = [(pile.pile_id, pile.free_slots())
+                          for mode in CHARGING_MODE for pile in self._available_piles(mode)]
+        pile_slots = self._pile_slots(available_piles)
+
+        t0 = time.perf_counter()
+        assignment, solver = budgeted_completion_assignment(
+            vehicles, pile_slots, Config.BATCH_SOLVER_TIME_BUDGET
+        )
+        latency = time.perf_counter() - t0
+        self.last_solver_stats = {
+            "solver": solver,
+            "latency_ms": latency * 1000,
+            "time_budget_ms": Config.BATCH_SOLVER_TIME_BUDGET * 1000,
+            "over_budget": latency > Config.BATCH_SOLVER_TIME_BUDGET,
+            "vehicles": len(vehicles),
+            "slots": sum(space for _, space in available_piles),
+            "total_completion_time": total_completion_time(assignment, pile_slots),
+        }
         return assignment
 
 
+class ShadowScheduler:
+    """影子调度器：在独立线程中用相同事件流驱动两个模拟充电站，对比生产策略与候选策略
+
+    生产策略的模拟副本作为基线，两者都从挂载时刻的空充电站开始，只在模拟时钟上推进会话，
+    不影响真实的车辆分配；事件通过队列传递，API 调用只承担一次入队
+    """
+
+    def __init__(self, production_policy: str, candidate_policy: str, dispatch_mode: str = "immediate",
+                 report_interval: Optional[float] = None):
+        self.production_policy = production_policy
+        self.candidate_policy = candidate_policy
+        self.report_interval = report_interval or Config.SHADOW_REPORT_INTERVAL
+        self.events = Queue()
+        self.stations = {
+            "production": chargingStation(policy=production_policy, simulated=True),
+            "candidate": chargingStation(policy=candidate_policy, simulated=True),
+        }
+        for station in self.stations.values():
+            station.dispatch_mode = dispatch_mode
+        self.arrivals = {name: {} for name in self.stations} # 用户ID -> 提交时刻
+        self.completions = {name: [] for name in self.stations} # 已完成请求的完成时长(秒)
+        self._bill_cursor = {name: 0 for name in self.stations}
+        self.event_count = 0
+        self.last_report = None
+        self._thread = None
+        self._stopped = False
+
+    def start(self):
+        """启动影子线程"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """停止影子线程，未处理的事件被丢弃"""
+        self._stopped = True
+        self.events.put(None)
+
+    def publish(self, t: float, kind: str, args: tuple):
+        """接收一个事件"""
+        self.events.put((t, kind, args))
+
+    def _run(self):
+        next_report = time.time() + self.report_interval
+        while not self._stopped:
+            try:
+                event = self.events.get(timeout=max(0.0, next_report - time.time()))
+            except Empty:
+                event = None
+            if event is not None:
+                try:
+                    self._apply(*event)
+                except Exception as e:
+                    print(f"Shadow scheduling error: {e}")
+            if time.time() >= next_report:
+                self.report(time.time())
+                next_report = time.time() + self.report_interval
+
+    def _apply(self, t: float, kind: str, args: tuple):
+        """在两个模拟充电站上重放事件"""
+        self.event_count += 1
+        for name, station in self.stations.items():
+            station.advance_to(t)
+            if kind == "submit":
+                user_id, mode, amount, battery_capacity = args
+                if station.submit_charging_request(user_id, mode, amount, battery_capacity):
+                    self.arrivals[name][user_id] = t
+            elif kind == "modify_mode":
+                station.modify_charging_mode(*args)
+            elif kind == "modify_amount":
+                station.modify_charging_amount(*args)
+            elif kind == "cancel":
+                if station.cancel_charging(*args):
+                    self.arrivals[name].pop(args[0], None)
+            elif kind == "end":
+                # 用户提前离开：在影子中可能还没开始充电
+                if not station.end_charging(*args) and station.cancel_charging(*args):
+                    self.arrivals[name].pop(args[0], None)
+            elif kind == "status":
+                station.set_pile_status(*args)
+            elif kind == "dispatch_mode":
+                station.set_dispatch_mode(*args)
+            # "complete" 只推进时钟，影子中的会话按各自的预计充满时刻结束
+
+    def _collect_completions(self, name: str):
+        """从新增详单中统计已离开充电站的请求的完成时长"""
+        station = self.stations[name]
+        bills = station.simulated_bills
+        last_bill = {}
+        for bill in bills[self._bill_cursor[name]:]:
+            last_bill[bill["user_id"]] = bill
+        self._bill_cursor[name] = len(bills)
+        for user_id, bill in last_bill.items():
+            # 故障中断后重新排队的车辆尚未完成
+            if user_id in station.user_locations:
+                continue
+            arrived = self.arrivals[name].pop(user_id, None)
+            if arrived is not None:
+                self.completions[name].append(bill["end_time"].timestamp() - arrived)
+
+    def report(self, now: float) -> dict:
+        """推进两个模拟充电站到 now，生成对比报告"""
+        report = {"time": now, "events": self.event_count}
+        for name, station in self.stations.items():
+            station.advance_to(now)
+            self._collect_completions(name)
+            metrics = station.get_dispatch_metrics()[station.dispatch_mode]
+            completions = self.completions[name]
+            report[name] = {
+                "policy": station.policy.name,
+                "sessions": metrics["sessions"],
+                "mean_wait": metrics["mean_wait"],
+                "mean_completion": sum(completions) / len(completions) if completions else 0.0,
+                "utilization": metrics["utilization"],
+                "in_station": len(station.user_locations),
+            }
+        self.last_report = report
+        production, candidate = report["production"], report["candidate"]
+        print(f"[影子调度] {production['policy']} vs {candidate['policy']}: "
+              f"平均等待 {production['mean_wait']:.1f}s / {candidate['mean_wait']:.1f}s, "
+              f"平均完成 {production['mean_completion']:.1f}s / {candidate['mean_completion']:.1f}s, "
+              f"利用率 {production['utilization']:.2%} / {candidate['utilization']:.2%}")
+        return report
+
+
 # API服务
 class ChargingStationAPI:
     """充电站API服务"""
     
-    def __init__(self):
-        self.station = chargingStation()
+    def __init__(self, policy: Optional[str] = None, db_manager: Optional[MongoDBManager] = None):
+        self.station = chargingStation(policy, db_manager=db_manager)
     
     # 用户相关API
     def register_user(self, username: str, password: str, **kwargs) -> dict:
@@ -1156,6 +3112,10 @@ class ChargingStationAPI:
             return {"success": True, "waiting_count": count}
         return {"success": False, "message": "查询失败"}
     
+    def get_waiting_metrics(self) -> dict:
+        """获取等候区最长等待和 p99 等待"""
+        return {"success": True, "metrics": self.station.get_waiting_metrics()}
+
     def get_waiting_area_info(self) -> dict:
         """获取等候区车辆信息"""
         info = self.station.get_waiting_area_info()
@@ -1215,6 +3175,36 @@ class ChargingStationAPI:
         status = self.station.get_pile_status(pile_id)
         return {"success": True, "status": status}
     
+    def get_available_piles(self, mode: Optional[str] = None) -> dict:
+        """获取有空位的充电桩"""
+        charging_mode = None
+        if mode:
+            charging_mode = CHARGING_MODE.FAST if mode.upper() == "FAST" else CHARGING_MODE.TRICKLE
+        piles = self.station.get_available_piles(charging_mode)
+        return {"success": True, "available_piles": piles}
+    
+    def set_dispatch_mode(self, dispatch_mode: str) -> dict:
+        """切换派车模式(immediate/batch)"""
+        if self.station.set_dispatch_mode(dispatch_mode.lower()):
+            return {"success": True, "dispatch_mode": dispatch_mode.lower()}
+        return {"success": False, "message": "无效的派车模式"}
+
+    def get_dispatch_metrics(self) -> dict:
+        """获取各派车模式的平均等待时长和充电桩利用率"""
+        return {"success": True, "metrics": self.station.get_dispatch_metrics()}
+
+    def attach_shadow(self, policy: str) -> dict:
+        """以候选策略启动影子调度"""
+        if self.station.attach_shadow(policy):
+            return {"success": True, "policy": policy}
+        return {"success": False, "message": "未知的调度策略"}
+
+    def get_shadow_report(self) -> dict:
+        """获取影子调度对比报告"""
+        if not self.station.shadow:
+            return {"success": False, "message": "影子调度未启用"}
+        return {"success": True, "report": self.station.get_shadow_report()}
+
     def get_pile_queue_cars(self, pile_id: Optional[str] = None) -> dict:
         """获取充电桩排队车辆信息"""
         cars = self.station.get_pile_queue_cars(pile_id)
@@ -1226,20 +3216,25 @@ class ChargingStationAPI:
         report = self.station.generate_report(start_time, end_time, period)
         return {"success": True, "report": report}
     
+    def rerate_bills(self) -> dict:
+        """按当前费率重算历史账单"""
+        result = self.station.rerate_bills()
+        return {"success": True, **result}
+    
     # 扩展调度API
     def batch_schedule_vehicles(self, mode: str) -> dict:
         """单次调度总充电时长最短"""
         charging_mode = CHARGING_MODE.FAST if mode.upper() == "FAST" else CHARGING_MODE.TRICKLE
         success = self.station.batch_schedule_vehicles(charging_mode)
         if success:
-            return {"success": True}
+            return {"success": True, "solver_stats": self.station.last_solver_stats}
         return {"success": False, "message": "批量调度失败"}
     
     def batch_schedule_all_vehicles(self) -> dict:
         """批量调度总充电时长最短"""
         success = self.station.batch_schedule_all_vehicles()
         if success:
-            return {"success": True}
+            return {"success": True, "solver_stats": self.station.last_solver_stats}
         return {"success": False, "message": "全局批量调度失败"}
 
 def real_test(api):
@@ -1327,6 +3322,259 @@ def fake_test(api):
     print("等待区：", api.get_waiting_area_info())
 
 
+def rerate_bill_arrays(start_times: np.ndarray, end_times: np.ndarray, charging_amounts: np.ndarray) -> dict:
+    """按当前 Config 费率批量重算账单费用及分时段明细，全部为向量化运算"""
+    period_seconds = TARIFF_CALENDAR.split_array(start_times, end_times)
+    total_seconds = period_seconds.sum(axis=0)
+    # 时长为0的账单电量记0，避免除零
+    shares = np.divide(period_seconds, total_seconds, out=np.zeros_like(period_seconds), where=total_seconds > 0)
+    result = {}
+    charging_fee = np.zeros_like(charging_amounts, dtype=np.float64)
+    for period, seconds, share, price in zip(TariffCalendar.PERIODS, period_seconds, shares, TARIFF_CALENDAR.prices()):
+        amount = charging_amounts * share
+        key = period.lower()
+        result[f"{key}_amount"] = amount
+        result[f"{key}_seconds"] = seconds
+        result[f"{key}_fee"] = amount * price
+        charging_fee += amount * price
+    service_fee = charging_amounts * Config.SERVICE_FEE_RATE
+    result.update({
+        "charging_fee": charging_fee,
+        "service_fee": service_fee,
+        "total_fee": charging_fee + service_fee,
+    })
+    return result
+
+
+def _to_datetime64(values: list) -> np.ndarray:
+    """将账单中的 datetime 或时间戳统一转换为 datetime64 数组"""
+    return np.array(
+        [value if isinstance(value, datetime) else datetime.fromtimestamp(value) for value in values],
+        dtype="datetime64[us]",
+    )
+
+
+def benchmark_rerate(bill_count: int = 1_000_000):
+    """基准测试：向量化重算账单(不含数据库读写)"""
+    rng = np.random.default_rng(0)
+    base = np.datetime64("2025-01-01T00:00:00", "us")
+    start_times = base + rng.integers(0, 365 * 86400, bill_count).astype("timedelta64[s]")
+    end_times = start_times + rng.integers(60, 12 * 3600, bill_count).astype("timedelta64[s]")
+    charging_amounts = rng.uniform(1, 100, bill_count)
+
+    t0 = time.perf_counter()
+    rerate_bill_arrays(start_times, end_times, charging_amounts)
+    cost = time.perf_counter() - t0
+
+    print(f"重算 {bill_count} 条账单耗时 {cost:.3f} 秒，约 {bill_count / cost * 60 / 1e6:.1f} 百万条/分钟")
+    return {"bill_count": bill_count, "seconds": cost}
+
+
+def benchmark_batch_assignment(vehicle_counts=(6, 50, 200), pile_count: int = 10,
+                               slots_per_pile: int = 20, seed: int = 0):
+    """基准测试：贪心分配与指派问题最优解的总完成时间和耗时对比"""
+    rng = np.random.default_rng(seed)
+    results = []
+    for count in vehicle_counts:
+        vehicles = [(f"user{i}", f"F{i}", {"amount": float(amount)})
+                    for i, amount in enumerate(rng.uniform(5, 100, count))]
+        pile_slots = [(f"P{i}", float(load), Config.FAST_CHARGING_POWER, slots_per_pile)
+                      for i, load in enumerate(rng.uniform(0, 0.5, pile_count))]
+        row = {"vehicles": count}
+        for name, solver in (("greedy", greedy_assignment), ("optimal", min_completion_assignment)):
+            t0 = time.perf_counter()
+            assignment = solver(vehicles, pile_slots)
+            row[f"{name}_ms"] = (time.perf_counter() - t0) * 1000
+            row[f"{name}_total"] = total_completion_time(assignment, pile_slots)
+        print(f"{count} 辆车: 贪心 总完成时间 {row['greedy_total']:.3f}h 耗时 {row['greedy_ms']:.2f}ms; "
+              f"最优 总完成时间 {row['optimal_total']:.3f}h 耗时 {row['optimal_ms']:.2f}ms")
+        results.append(row)
+    return results
+
+
+def benchmark_policies(policies: Optional[List[str]] = None, arrivals: int = 200, hours: float = 8,
+                       faults: int = 4, seed: int = 0) -> Dict[str, dict]:
+    """基准测试：在模拟充电站上用相同的到达和故障序列比较各调度策略
+
+    返回各策略的完成车辆数、吞吐量(辆/小时)、平均等待时长和平均完成时长(小时)
+    """
+    rng = np.random.default_rng(seed)
+    horizon = hours * 3600
+    events = []
+    for i, t in enumerate(np.sort(rng.uniform(0, horizon, arrivals))):
+        mode = CHARGING_MODE.FAST if rng.random() < 0.5 else CHARGING_MODE.TRICKLE
+        events.append((float(t), "submit", (f"sim{i}", mode, float(rng.uniform(5, 60)))))
+    pile_count = Config.FAST_CHARGING_PILE_NUM + Config.TRICKLE_CHARGING_PILE_NUM
+    for t in rng.uniform(0, horizon, faults):
+        pile_id = chr(ord('A') + int(rng.integers(pile_count)))
+        events.append((float(t), "status", (pile_id, PILE_STATUS.FAULT)))
+        events.append((float(t) + float(rng.uniform(600, 3600)), "status", (pile_id, PILE_STATUS.AVAILABLE)))
+    events.sort(key=lambda e: e[0])
+
+    results = {}
+    for name in policies or list(SCHEDULING_POLICIES):
+        station = chargingStation(policy=name, simulated=True)
+        start = station.clock()
+        arrived = {}
+        rejected = 0
+        for t, kind, args in events:
+            station.advance_to(start + t)
+            if kind == "submit":
+                user_id, mode, amount = args
+                if station.submit_charging_request(user_id, mode, amount):
+                    arrived[user_id] = start + t
+                else:
+                    rejected += 1
+            else:
+                station.set_pile_status(*args)
+        # 不再有新到达，跑完剩余的会话
+        station.advance_to(start + horizon * 10)
+
+        # 故障中断的会话会产生多张详单，以最后一张为准
+        finished = {bill["user_id"]: bill["end_time"].timestamp() for bill in station.simulated_bills}
+        completed = [user_id for user_id in finished if user_id in arrived and user_id not in station.user_locations]
+        makespan = (max(finished.values()) - start) / 3600 if finished else 0.0
+        metrics = station.get_dispatch_metrics()[station.dispatch_mode]
+        results[name] = {
+            "completed": len(completed),
+            "rejected": rejected,
+            "throughput": len(completed) / makespan if makespan else 0.0,
+            "mean_wait": metrics["mean_wait"] / 3600,
+            "mean_completion": (
+                sum(finished[u] - arrived[u] for u in completed) / len(completed) / 3600 if completed else 0.0
+            ),
+        }
+        print(f"{name}: 完成 {len(completed)} 辆, 拒绝 {rejected} 辆, 吞吐量 {results[name]['throughput']:.2f} 辆/小时, "
+              f"平均等待 {results[name]['mean_wait']:.3f}h, 平均完成 {results[name]['mean_completion']:.3f}h")
+    return results
+
+
+def benchmark_read_contention(clients: int = 100, writers: int = 4, duration: float = 3.0,
+                              poll_interval: float = 0.01, exclusive: bool = False,
+                              read_lock: bool = False, db_manager: Optional[MongoDBManager] = None) -> dict:
+    """读写竞争基准测试：clients 个客户端轮询看板查询，writers 个线程不断提交/取消充电请求
+
+    统计查询和写操作的延迟；默认查询无锁读取快照。exclusive 为 True 时查询获取写锁，复现所有操作互斥的行为，
+    read_lock 为 True 时查询获取读锁，复现引入快照之前的行为，二者作为对照；db_manager 同 chargingStation
+    """
+    station = chargingStation(db_manager=db_manager)
+    user_ids = [
+        station.register_user({"username": f"rw{i}", "password": "password"})["user_id"]
+        for i in range(writers)
+    ]
+    stop = threading.Event()
+    read_latencies = []
+    write_latencies = []
+
+    def poll(index: int):
+        user_id = user_ids[index % writers]
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            if exclusive:
+                with station.locked():
+                    station.get_pile_status()
+                    station.get_waiting_area_info()
+                    station.get_waiting_count(user_id)
+            elif read_lock:
+                with ExitStack() as stack:
+                    for shard in station.shards.values():
+                        stack.enter_context(shard.lock.read())
+                    station.get_pile_status()
+                    station.get_waiting_area_info()
+                    station.get_waiting_count(user_id)
+            else:
+                station.get_pile_status()
+                station.get_waiting_area_info()
+                station.get_waiting_count(user_id)
+            read_latencies.append(time.perf_counter() - t0)
+            time.sleep(poll_interval)
+
+    def write(user_id: str):
+        modes = [CHARGING_MODE.FAST, CHARGING_MODE.TRICKLE]
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            station.submit_charging_request(user_id, modes[len(write_latencies) % 2], 10)
+            station.cancel_charging(user_id)
+            write_latencies.append(time.perf_counter() - t0)
+
+    threads = [threading.Thread(target=poll, args=(i,), daemon=True) for i in range(clients)]
+    threads += [threading.Thread(target=write, args=(user_id,), daemon=True) for user_id in user_ids]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    station.shutdown()
+
+    def summary(samples: list) -> dict:
+        samples = sorted(samples)
+        return {
+            "ops_per_second": len(samples) / duration,
+            "p50_ms": samples[len(samples) // 2] * 1000 if samples else 0.0,
+            "p99_ms": samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000 if samples else 0.0,
+        }
+
+    result = {"reads": summary(read_latencies), "writes": summary(write_latencies)}
+    label = "互斥锁" if exclusive else "读写锁" if read_lock else "快照"
+    print(f"读写竞争({label}, {clients} 个轮询客户端): "
+          f"查询 {result['reads']['ops_per_second']:.0f}/s p99 {result['reads']['p99_ms']:.2f}ms, "
+          f"写入 {result['writes']['ops_per_second']:.0f}/s p99 {result['writes']['p99_ms']:.2f}ms")
+    return result
+
+
+def benchmark_queue(sizes=(10 ** 3, 10 ** 4, 10 ** 5), operations: int = 1000):
+    """基准测试：list 与 IndexedQueue 的队首弹出、队首插入和按用户删除"""
+    results = []
+    for size in sizes:
+        entries = [(f"user{i}", f"F{i}", {"amount": 10}) for i in range(size)]
+        victims = [f"user{i}" for i in range(0, size, max(size // operations, 1))][:operations]
+        timings = {}
+        for name, factory in (("list", list), ("IndexedQueue", IndexedQueue)):
+            queue = factory(entries)
+            t0 = time.perf_counter()
+            if name == "list":
+                for _ in range(operations):
+                    queue.insert(0, queue.pop(0))
+                for user_id in victims:
+                    for i, entry in enumerate(queue):
+                        if entry[0] == user_id:
+                            queue.pop(i)
+                            break
+            else:
+                for _ in range(operations):
+                    queue.appendleft(queue.popleft())
+                for user_id in victims:
+                    queue.remove(user_id)
+            timings[name] = (time.perf_counter() - t0) / (2 * operations) * 1e6
+        print(f"队列长度 {size}: list {timings['list']:.2f} us/次, IndexedQueue {timings['IndexedQueue']:.2f} us/次")
+        results.append({"size": size, **timings})
+    return results
+
+
+def benchmark_time_period(hours: float = 10, rounds: int = 200):
+    """基准测试：逐分钟循环 vs 按时段边界切分"""
+    calculator = TIME_PERIOD(time.time())
+    start = datetime(2025, 6, 1, 6, 30, 15)
+    end = start + timedelta(hours=hours)
+
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        loop_result = calculator._calculate_time_period_by_minute(start, end)
+    loop_cost = (time.perf_counter() - t0) / rounds
+
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        fast_result = calculator.calculate_time_period(start, end)
+    fast_cost = (time.perf_counter() - t0) / rounds
+
+    print(f"充电时长 {hours} 小时，各执行 {rounds} 次")
+    print(f"逐分钟循环: {loop_cost * 1e6:.1f} us/次 -> {loop_result}")
+    print(f"边界切分:   {fast_cost * 1e6:.1f} us/次 -> {fast_result}")
+    print(f"加速比: {loop_cost / fast_cost:.1f}x")
+    return {"loop_us": loop_cost * 1e6, "boundary_us": fast_cost * 1e6}
+
+
 if __name__ == "__main__":
     api = ChargingStationAPI()
     # real_test(api)
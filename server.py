@@ -79,36 +79,11 @@ def get_queue_number(user_id):
 
     # 如果找到队列号码，添加更多详细信息
     if result.get("success") and result.get("queue_number"):
-        queue_number = result["queue_number"]
-        user_id_str = user_id
-
-        # 检查用户是否在充电桩充电或排队
-        for pile_id, pile in api.station.piles.items():
-            # 检查是否正在充电
-            if pile.charging_vehicle and pile.charging_vehicle[0] == user_id_str:
-                # 用户正在充电桩充电
-                result["position"] = "charging"
-                result["pile_id"] = pile_id
-                break
-
-            # 检查是否在充电桩排队
-            for i, (queue_user_id, _, _) in enumerate(pile.queue):
-                if queue_user_id == user_id_str:
-                    # 用户在充电桩队列中等待
-                    result["position"] = "queuing"
-                    result["pile_id"] = pile_id
-                    result["queue_position"] = i + 1  # 队列中的位置（从1开始）
-                    break
-
-        # 如果不在充电桩，那么就在等候区
-        if "position" not in result:
-            for mode in api.station.waiting_area:
-                for i, (waiting_user_id, _, _) in enumerate(api.station.waiting_area[mode]):
-                    if waiting_user_id == user_id_str:
-                        # 用户在等候区等待
-                        result["position"] = "waiting_area"
-                        result["waiting_position"] = i + 1  # 等候区的位置（从1开始）
-                        break
+        # 通过位置索引直接获取用户在等候区、充电桩排队或正在充电
+        position = api.station.get_user_position(user_id)
+        if position:
+            position.pop("queue_number", None)
+            result.update(position)
 
     return jsonify(result)
 
@@ -157,6 +132,39 @@ def set_pile_status():
     return jsonify(result)
 
 
+@app.route('/api/admin/available-piles', methods=['GET'])
+def get_available_piles():
+    mode = request.args.get('mode')
+    result = api.get_available_piles(mode)
+    return jsonify(result)
+
+@app.route('/api/admin/dispatch-mode', methods=['POST'])
+def set_dispatch_mode():
+    data = request.get_json()
+    result = api.set_dispatch_mode(data['mode'])
+    return jsonify(result)
+
+@app.route('/api/admin/dispatch-metrics', methods=['GET'])
+def get_dispatch_metrics():
+    result = api.get_dispatch_metrics()
+    return jsonify(result)
+
+@app.route('/api/admin/shadow', methods=['POST'])
+def attach_shadow():
+    data = request.get_json()
+    result = api.attach_shadow(data['policy'])
+    return jsonify(result)
+
+@app.route('/api/admin/shadow-report', methods=['GET'])
+def get_shadow_report():
+    result = api.get_shadow_report()
+    return jsonify(result)
+
+@app.route('/api/admin/waiting-metrics', methods=['GET'])
+def get_waiting_metrics():
+    result = api.get_waiting_metrics()
+    return jsonify(result)
+
 @app.route('/api/admin/pile-queue-cars', methods=['GET'])
 def get_pile_queue_cars():
     pile_id = request.args.get('pile_id')
@@ -186,5 +194,10 @@ def generate_report():
     )
     return jsonify(result)
 
+@app.route('/api/admin/rerate-bills', methods=['POST'])
+def rerate_bills():
+    result = api.rerate_bills()
+    return jsonify(result)
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
\ No newline at end of file
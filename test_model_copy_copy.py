@@ -0,0 +1,417 @@
+import random
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+import bcrypt
+import numpy as np
+import pytest
+
+import model_copy_copy
+from model_copy_copy import (
+    CHARGING_MODE,
+    Config,
+    PILE_STATUS,
+    TARIFF_CALENDAR,
+    TIME_PERIOD,
+    ChargingPile,
+    benchmark_read_contention,
+    budgeted_completion_assignment,
+    chargingStation,
+    min_completion_assignment,
+    total_completion_time,
+)
+
+
+def assert_backlog_consistent(pile: ChargingPile):
+    """充电桩排队时间的增量维护结果与逐车重算一致"""
+    expected = pile._get_waiting_time_estimate_by_scan()
+    actual = pile.get_waiting_time_estimate()
+    assert abs(expected - actual) < 1e-6, f"充电桩 {pile.pile_id} 排队时间不一致: {expected} != {actual}"
+
+
+def test_backlog_consistent_through_pile_operations():
+    """入队、取消、结束充电、故障清空队列后排队时间保持一致"""
+    rng = random.Random(0)
+    pile = ChargingPile("T", CHARGING_MODE.FAST)
+    next_id = 0
+
+    for _ in range(2000):
+        action = rng.random()
+        if action < 0.4:
+            next_id += 1
+            user_id = f"user{next_id}"
+            pile.add_to_queue(user_id, user_id, {"amount": rng.uniform(1, 60)})
+        elif action < 0.6:
+            candidates = list(pile.queue) + ([pile.charging_vehicle] if pile.charging_vehicle else [])
+            if candidates:
+                user_id, queue_number = rng.choice(candidates)[:2]
+                pile.remove_from_queue(user_id, queue_number)
+        elif action < 0.85:
+            if pile.charging_vehicle:
+                pile.finish_charging()
+        else:
+            # 故障：结束当前会话并清空队列，随后恢复
+            pile.set_status(PILE_STATUS.FAULT)
+            pile.clear_queue()
+            pile.set_status(PILE_STATUS.AVAILABLE)
+        assert_backlog_consistent(pile)
+
+
+def test_backlog_consistent_through_station_amount_modification():
+    """经充电站修改充电量、派车、取消、结束充电和充电桩故障/恢复后，各充电桩排队时间保持一致
+
+    只有等候区的车辆可以修改充电量，已进入充电桩队列的车辆修改被拒绝，充电桩的排队电量不会失效
+    """
+    rng = random.Random(1)
+    station = chargingStation(simulated=True)
+    users = [f"user{i}" for i in range(12)]
+    modified_waiting = 0
+
+    for _ in range(3000):
+        user_id = rng.choice(users)
+        action = rng.random()
+        if action < 0.3:
+            mode = rng.choice(list(CHARGING_MODE))
+            station.submit_charging_request(user_id, mode, rng.uniform(1, 40))
+        elif action < 0.55:
+            location = station.user_locations.get(user_id)
+            modified = station.modify_charging_amount(user_id, rng.uniform(1, 40))
+            if location and location[2] is not None:
+                assert not modified
+            elif location:
+                assert modified
+                modified_waiting += 1
+        elif action < 0.65:
+            station.cancel_charging(user_id)
+        elif action < 0.75:
+            station.end_charging(user_id)
+        elif action < 0.8:
+            pile_id = rng.choice(list(station.piles))
+            station.set_pile_status(pile_id, rng.choice([PILE_STATUS.FAULT, PILE_STATUS.OFF, PILE_STATUS.AVAILABLE]))
+        else:
+            station.advance_to(station.clock() + rng.uniform(0, 1800))
+        for pile in station.piles.values():
+            assert_backlog_consistent(pile)
+
+    assert modified_waiting > 0
+
+
+class SlowUserStore:
+    """测试用的内存数据库：密码用真实的 bcrypt 校验，其余操作按固定网络延迟休眠"""
+
+    def __init__(self, io_latency: float = 0.005):
+        self.io_latency = io_latency
+        self.users = {}
+        self.bills = []
+
+    def register_user(self, user_info: dict, role: str = "user") -> dict:
+        hashed_password = bcrypt.hashpw(user_info["password"].encode('utf-8'), bcrypt.gensalt())
+        time.sleep(self.io_latency)
+        user_id = str(uuid.uuid4())
+        self.users[user_id] = dict(user_info, user_id=user_id, password=hashed_password, role=role)
+        return {"success": True, "user_id": user_id}
+
+    def register_admin(self, user_info: dict) -> dict:
+        return self.register_user(user_info, "admin")
+
+    def login(self, username: str, password: str) -> dict:
+        time.sleep(self.io_latency)
+        for user in list(self.users.values()):
+            if user["username"] == username and bcrypt.checkpw(password.encode('utf-8'), user["password"]):
+                return {"success": True, "user_id": user["user_id"], "username": username, "role": user["role"]}
+        return {"success": False, "message": "用户名或密码错误"}
+
+    def get_user_by_id(self, user_id: str) -> dict:
+        time.sleep(self.io_latency)
+        user = self.users.get(user_id)
+        return {"success": True, "user": dict(user)} if user else {"success": False}
+
+    def save_bill(self, bill: dict) -> bool:
+        time.sleep(self.io_latency)
+        self.bills.append(bill)
+        return True
+
+    def get_user_bills(self, user_id: str) -> list:
+        time.sleep(self.io_latency)
+        return [bill for bill in self.bills if bill["user_id"] == user_id]
+
+    def get_all_bills(self) -> list:
+        time.sleep(self.io_latency)
+        return list(self.bills)
+
+
+def run_login_storm(clients: int, duration: float, hold_lock: bool) -> dict:
+    """测量登录风暴期间分片写锁的阻塞时间
+
+    clients 个线程持续登录，同时一个探测线程每 5ms 获取一次快充分片写锁并记录等待时间，
+    另一个线程不断提交/取消充电请求，记录从提交到被调度进充电桩的时间。
+    hold_lock 为 True 时登录在分片锁内进行，复现改动前的行为作为对照
+    """
+    station = chargingStation(db_manager=SlowUserStore())
+    for i in range(clients):
+        station.register_user({"username": f"storm{i}", "password": "password"})
+    driver_id = station.register_user({"username": "driver", "password": "password"})["user_id"]
+
+    stop = threading.Event()
+    probe_latencies = []
+    dispatch_latencies = []
+
+    def storm(index: int):
+        while not stop.is_set():
+            if hold_lock:
+                with station.locked():
+                    station.login(f"storm{index}", "password")
+            else:
+                station.login(f"storm{index}", "password")
+
+    def probe():
+        shard = station.shards[CHARGING_MODE.FAST]
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            with shard.lock:
+                probe_latencies.append(time.perf_counter() - t0)
+            time.sleep(0.005)
+
+    def driver():
+        while not stop.is_set():
+            t0 = time.perf_counter()
+            if not station.submit_charging_request(driver_id, CHARGING_MODE.FAST, 1):
+                time.sleep(0.01)
+                continue
+            while not stop.is_set():
+                location = station.user_locations.get(driver_id)
+                if location and location[2] is not None:
+                    dispatch_latencies.append(time.perf_counter() - t0)
+                    break
+                time.sleep(0.001)
+            station.cancel_charging(driver_id)
+
+    threads = [threading.Thread(target=storm, args=(i,), daemon=True) for i in range(clients)]
+    threads += [threading.Thread(target=probe, daemon=True), threading.Thread(target=driver, daemon=True)]
+    for thread in threads:
+        thread.start()
+    time.sleep(duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    station.shutdown()
+
+    def summary(samples: list) -> Optional[dict]:
+        # 没有样本说明该线程在整个测试期间都没能完成一次操作，不能报告为 0 延迟
+        if not samples:
+            return None
+        samples = sorted(samples)
+        return {
+            "count": len(samples),
+            "p99_ms": samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1000,
+            "max_ms": samples[-1] * 1000,
+        }
+
+    return {"lock_wait": summary(probe_latencies), "dispatch": summary(dispatch_latencies)}
+
+
+def test_login_storm_does_not_block_shard_lock():
+    """登录在分片锁外校验密码，登录风暴期间写锁和调度不被阻塞；锁内登录作为对照会阻塞写锁"""
+    relaxed = run_login_storm(clients=4, duration=1.0, hold_lock=False)
+    assert relaxed["lock_wait"] is not None
+
+    stalled = run_login_storm(clients=4, duration=1.0, hold_lock=True)
+    assert stalled["lock_wait"] is None or stalled["lock_wait"]["max_ms"] > relaxed["lock_wait"]["max_ms"]
+
+
+def test_station_shutdown_stops_background_threads():
+    """shutdown 后调度线程和定时线程退出"""
+    station = chargingStation(db_manager=SlowUserStore(io_latency=0))
+    threads = [shard.thread for shard in station.shards.values()] + [station.timer._thread]
+    assert all(thread.is_alive() for thread in threads)
+    station.shutdown()
+    assert not any(thread.is_alive() for thread in threads)
+
+
+def test_read_contention_benchmark_runs():
+    """读写竞争基准测试在快照读取下查询和写入都能完成"""
+    result = benchmark_read_contention(clients=10, writers=2, duration=0.5,
+                                       db_manager=SlowUserStore(io_latency=0))
+    assert result["reads"]["ops_per_second"] > 0
+    assert result["writes"]["ops_per_second"] > 0
+
+
+def test_fault_interrupted_user_cannot_be_admitted_twice():
+    """故障中断的车辆重新调度之前，同一用户在另一模式的提交被拒绝，用户只占用一个位置"""
+    station = chargingStation(simulated=True)
+    for i in range(len(station.piles)):
+        station.submit_charging_request(f"user{i}", CHARGING_MODE.FAST, 30)
+    user_id, fault_pile_id = next(
+        (location_user, location[2]) for location_user, location in station.user_locations.items()
+        if location[2] is not None and station.piles[location[2]].charging_vehicle[0] == location_user
+    )
+
+    on_fault = station.policy.on_fault
+    resubmitted = []
+
+    def on_fault_with_resubmit(station_, fault_pile, fault_queue):
+        # 故障处理重新调度之前，另一分片收到同一用户的提交
+        resubmitted.append(station.submit_charging_request(user_id, CHARGING_MODE.TRICKLE, 10))
+        on_fault(station_, fault_pile, fault_queue)
+
+    station.policy.on_fault = on_fault_with_resubmit
+    station.set_pile_status(fault_pile_id, PILE_STATUS.FAULT)
+
+    assert resubmitted == [None]
+    placements = [pile.pile_id for pile in station.piles.values()
+                  if any(entry[0] == user_id for entry in pile.queue)
+                  or (pile.charging_vehicle and pile.charging_vehicle[0] == user_id)]
+    placements += [mode for mode, lane in station.waiting_area.items() if lane.get(user_id)]
+    assert len(placements) == 1
+    assert station.user_locations[user_id][1] == CHARGING_MODE.FAST
+
+
+def test_fault_vehicles_served_before_normal_vehicles_within_max_wait():
+    """故障车辆排在未超过 MAX_WAIT 的普通车辆之前；普通车辆等待超过 MAX_WAIT 后不再被插队"""
+    station = chargingStation(simulated=True)
+    fast_piles = [pile for pile in station.piles.values() if pile.mode == CHARGING_MODE.FAST]
+    occupied = len(fast_piles) * Config.CHARGING_QUEUE_LEN
+    for i in range(occupied):
+        station.submit_charging_request(f"c{i}", CHARGING_MODE.FAST, 1000)
+    station.submit_charging_request("w1", CHARGING_MODE.FAST, 1000)
+    assert station.waiting_area[CHARGING_MODE.FAST].head(1)[0][0] == "w1"
+
+    station.advance_to(station.clock() + Config.MAX_WAIT * 2 / 3)
+    fault_pile = next(pile for pile in fast_piles if pile.charging_vehicle[0] == "c0")
+    displaced = ["c0"] + [entry[0] for entry in fault_pile.queue]
+    station.set_pile_status(fault_pile.pile_id, PILE_STATUS.FAULT)
+
+    waiting = station.waiting_area[CHARGING_MODE.FAST]
+    order = [entry[0] for entry in waiting.head(len(waiting))]
+    assert order == displaced + ["w1"]
+    assert [entry[0] for entry in station.snapshot.waiting[CHARGING_MODE.FAST].order(station.clock())] == order
+
+    station.advance_to(station.clock() + Config.MAX_WAIT / 3 + 1)
+    order = [entry[0] for entry in waiting.head(len(waiting))]
+    assert order == ["w1"] + displaced
+
+
+def batch_instance(count: int, seed: int = 0):
+    """批量分配测试数据：count 辆车和恰好 count 个空位"""
+    rng = random.Random(seed)
+    vehicles = [(f"user{i}", f"F{i}", {"amount": rng.uniform(5, 100)}) for i in range(count)]
+    pile_slots = [(f"P{i}", rng.uniform(0, 0.5), rng.choice([Config.FAST_CHARGING_POWER, Config.TRICKLE_CHARGING_POWER]), 2)
+                  for i in range(count // 2)]
+    return vehicles, pile_slots
+
+
+def test_budgeted_assignment_uses_exact_solution_within_budget():
+    """精确求解在预算内完成时返回精确解"""
+    vehicles, pile_slots = batch_instance(20)
+    assignment, solver = budgeted_completion_assignment(vehicles, pile_slots, 5.0)
+    assert solver == "linear_sum_assignment"
+    assert total_completion_time(assignment, pile_slots) == total_completion_time(
+        min_completion_assignment(vehicles, pile_slots), pile_slots)
+
+
+def test_budgeted_assignment_returns_incumbent_when_exact_solve_overruns(monkeypatch):
+    """精确求解超出预算时按时返回局部搜索的最好方案，每辆车恰好分配一次"""
+    release = threading.Event()
+
+    def stalled_exact_solve(vehicles, pile_slots):
+        release.wait()
+        return {}
+
+    monkeypatch.setattr(model_copy_copy, "min_completion_assignment", stalled_exact_solve)
+    vehicles, pile_slots = batch_instance(20)
+    try:
+        t0 = time.perf_counter()
+        assignment, solver = budgeted_completion_assignment(vehicles, pile_slots, 0.05)
+        elapsed = time.perf_counter() - t0
+    finally:
+        release.set()
+    assert solver == "local_search"
+    assert elapsed < 5.0
+    assigned = sorted(vehicle[0] for queue in assignment.values() for vehicle in queue)
+    assert assigned == sorted(vehicle[0] for vehicle in vehicles)
+
+
+def assert_ranks_and_locations_consistent(station: chargingStation):
+    """等候区和快照的排名等于用户在叫号顺序中的下标，位置索引与车辆实际所在位置一致"""
+    now = station.clock()
+    snapshot = station.snapshot
+    placements = {}
+    for mode, waiting in station.waiting_area.items():
+        order = waiting.head(len(waiting))
+        assert [row[0] for row in snapshot.waiting[mode].order(now)] == [entry[0] for entry in order]
+        for index, (user_id, queue_number, _) in enumerate(order):
+            assert waiting.rank(user_id) == index
+            assert snapshot.waiting[mode].rank(user_id, now) == index
+            placements[user_id] = (queue_number, mode, None)
+    for pile in station.piles.values():
+        entries = list(pile.queue) + ([pile.charging_vehicle] if pile.charging_vehicle else [])
+        for user_id, queue_number, *_ in entries:
+            assert user_id not in placements
+            placements[user_id] = (queue_number, pile.mode, pile.pile_id)
+    assert station.user_locations == placements
+    for user_id, location in placements.items():
+        assert snapshot.locations.get(user_id) == location
+
+
+def test_ranks_follow_order_through_cancel_mode_change_and_fault():
+    """提交、取消、修改充电模式、结束充电和充电桩故障/恢复后，排名与叫号顺序及位置索引保持一致"""
+    rng = random.Random(2)
+    station = chargingStation(simulated=True)
+    users = [f"user{i}" for i in range(30)]
+
+    for _ in range(3000):
+        user_id = rng.choice(users)
+        action = rng.random()
+        if action < 0.35:
+            station.submit_charging_request(user_id, rng.choice(list(CHARGING_MODE)), rng.uniform(20, 400))
+        elif action < 0.5:
+            station.cancel_charging(user_id)
+        elif action < 0.65:
+            station.modify_charging_mode(user_id, rng.choice(list(CHARGING_MODE)))
+        elif action < 0.7:
+            station.end_charging(user_id)
+        elif action < 0.8:
+            pile_id = rng.choice(list(station.piles))
+            station.set_pile_status(pile_id, rng.choice([PILE_STATUS.FAULT, PILE_STATUS.AVAILABLE]))
+        else:
+            station.advance_to(station.clock() + rng.uniform(0, Config.MAX_WAIT))
+        assert_ranks_and_locations_consistent(station)
+
+
+@pytest.mark.parametrize("start, end, expected", [
+    # (峰, 平, 谷) 秒数
+    (datetime(2025, 3, 1, 9, 59, 59, 500000), datetime(2025, 3, 1, 10, 0, 0, 250000), (0.25, 0.5, 0.0)),
+    (datetime(2025, 3, 1, 22, 30), datetime(2025, 3, 2, 1, 15), (0.0, 1800.0, 8100.0)),
+    (datetime(2025, 3, 1, 12, 0), datetime(2025, 3, 3, 12, 0), (16 * 3600.0, 16 * 3600.0, 16 * 3600.0)),
+    (datetime(2025, 3, 1, 6, 59), datetime(2025, 3, 1, 7, 1), (0.0, 60.0, 60.0)),
+    (datetime(2025, 3, 1, 7, 0), datetime(2025, 3, 1, 7, 0), (0.0, 0.0, 0.0)),
+    (datetime(2025, 3, 1, 10, 0), datetime(2025, 3, 1, 10, 0, 1), (1.0, 0.0, 0.0)),
+    (datetime(2025, 3, 1, 23, 0), datetime(2025, 3, 1, 23, 0, 0, 1), (0.0, 0.0, 1e-6)),
+])
+def test_tariff_split_is_exact(start, end, expected):
+    """按时段边界拆分的结果精确到微秒：亚秒级起点、跨零点、跨多天和恰好落在边界上的时刻"""
+    assert TARIFF_CALENDAR.split(start, end) == pytest.approx(expected, abs=1e-9)
+    assert TARIFF_CALENDAR.split(start.timestamp(), end.timestamp()) == pytest.approx(expected, abs=1e-6)
+    split = TARIFF_CALENDAR.split_array(np.array([start], dtype="datetime64[us]"), np.array([end], dtype="datetime64[us]"))
+    assert split[:, 0] == pytest.approx(expected, abs=1e-9)
+
+
+def test_tariff_split_matches_minute_loop_on_whole_minutes():
+    """整分钟区间的结果与旧的逐分钟统计一致，7:00 等边界归属相同"""
+    rng = random.Random(4)
+    calculator = TIME_PERIOD(datetime(2025, 3, 1))
+    for _ in range(200):
+        start = datetime(2025, 3, 1) + timedelta(minutes=rng.randrange(2 * 24 * 60))
+        end = start + timedelta(minutes=rng.randrange(36 * 60))
+        assert calculator.calculate_time_period(start, end) == calculator._calculate_time_period_by_minute(start, end)
+
+
+def test_period_of_instant_matches_segments():
+    """单个时刻的时段判断与 PERIOD_SEGMENTS 一致，区间为 [起点, 终点)"""
+    day = datetime(2025, 3, 1)
+    for seg_start, seg_end, period in TIME_PERIOD.PERIOD_SEGMENTS:
+        assert TIME_PERIOD(day + timedelta(seconds=seg_start)).get_period() == period
+        assert TIME_PERIOD(day + timedelta(seconds=seg_end, microseconds=-1)).get_period() == period